@@ -0,0 +1,873 @@
+#!/usr/bin/python3
+
+import collections
+import http.server
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from scriptloader import loadScript
+
+
+class NullLogger(object):
+    def log(self, logStr):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Timer(object):
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.threadCpu = 0.0
+
+    def __enter__(self):
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+        self.threadCpuStart = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self.wallStart
+        self.cpu = time.process_time() - self.cpuStart
+        self.threadCpu = time.thread_time() - self.threadCpuStart
+
+
+def report(name, count, timer, unit="telegram", threadCpu=False):
+    # CPU of the whole process, or only of the calling thread
+    cpu = timer.threadCpu if threadCpu else timer.cpu
+    print("%-28s %9d %ss  %10.0f %ss/s  %8.2f us CPU/%s" % (
+        name, count, unit, count / timer.wall, unit, cpu * 1e6 / count, unit))
+
+
+class FakeSerial(object):
+    # serves a byte stream in chunks like a serial port with data arriving in bursts
+    def __init__(self, data, chunkSize):
+        self.data = data
+        self.pos = 0
+        self.chunkSize = chunkSize
+
+    @property
+    def in_waiting(self):
+        return min(self.chunkSize, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+def syntheticCulStream(count):
+    telegrams = [b"F404B8111", b"K31124357", b"H155601150100", b"F5E7E132000", b"LOVF"]
+    return b"".join(telegrams[i % len(telegrams)] + b"\r\n" for i in range(count))
+
+
+def legacyCulRead(cul, count):
+    # the former Fs20.run loop: one read(1) and one string concatenation per byte
+    received = 0
+    while received < count:
+        c = ''
+        telegram = ''
+        while c != '\n':
+            c = cul.read(1).decode()
+            telegram += c
+        telegram = telegram[:-2]
+        received += 1
+    return received
+
+
+def benchSerialReader(args):
+    count = int(args[0]) if args else 200000
+    chunkSize = int(args[1]) if len(args) > 1 else 64
+    fs20serv = loadScript("fs20-serv.py")
+    data = syntheticCulStream(count)
+    print("serial reader: %d telegrams, %d bytes, %d bytes per burst" % (count, len(data), chunkSize))
+
+    with Timer() as timer:
+        received = legacyCulRead(FakeSerial(data, chunkSize), count)
+    report("before (read(1) per byte)", received, timer)
+
+    reader = fs20serv.CulReader(FakeSerial(data, chunkSize))
+    received = 0
+    with Timer() as timer:
+        while received < count:
+            received += len(reader.read())
+    report("after (CulReader)", received, timer)
+
+
+def startServer(serverClass, fs20serv, config=None):
+    fs20 = fs20serv.Fs20([], NullLogger(), config or fs20serv.Config())
+    server = serverClass(host="127.0.0.1", port=0, fs20=fs20, logger=NullLogger())
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    while server.socket is None:
+        time.sleep(0.01)
+    return fs20, server.socket.getsockname()
+
+
+def connectClients(address, count, recvBufferSize=None):
+    clients = []
+    for i in range(count):
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if recvBufferSize:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recvBufferSize)
+            try:
+                sock.connect(address)
+                break
+            except ConnectionRefusedError:
+                sock.close()
+                time.sleep(0.01)
+        clients.append(sock)
+    return clients
+
+
+def receiveLines(clients, expected, idleTimeout=10):
+    selector = selectors.DefaultSelector()
+    pending = {}
+    for sock in clients:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        pending[sock] = expected
+    while pending:
+        events = selector.select(timeout=idleTimeout)
+        if not events:
+            break
+        for key, mask in events:
+            data = key.fileobj.recv(65536)
+            pending[key.fileobj] -= data.count(b"\n")
+            if pending[key.fileobj] <= 0 or not data:
+                selector.unregister(key.fileobj)
+                del pending[key.fileobj]
+    selector.close()
+
+
+def benchSocketServer(args):
+    clientCount = int(args[0]) if args else 150
+    telegramCount = int(args[1]) if len(args) > 1 else 2000
+    fs20serv = loadScript("fs20-serv.py")
+    print("socket server: %d clients, %d telegrams broadcast to each" % (clientCount, telegramCount))
+    for name, serverClass in (("threaded", fs20serv.SocketServer), ("asyncio", fs20serv.AsyncSocketServer)):
+        threadsBefore = threading.active_count()
+        fs20, address = startServer(serverClass, fs20serv)
+        clients = connectClients(address, clientCount)
+        while len(fs20.clients) < clientCount:
+            time.sleep(0.01)
+        threads = threading.active_count() - threadsBefore
+        receiver = threading.Thread(target=receiveLines, args=(clients, telegramCount))
+        receiver.start()
+        with Timer() as timer:
+            for i in range(telegramCount):
+                fs20.distribute("F404B81%02X" % (i % 256))
+            receiver.join()
+        report("%s (%d server threads)" % (name, threads), telegramCount * clientCount, timer, unit="line")
+        for sock in clients:
+            sock.close()
+        while fs20.clients:
+            time.sleep(0.01)
+
+
+def benchSlowConsumer(args):
+    stalledCount = int(args[0]) if args else 5
+    telegramCount = int(args[1]) if len(args) > 1 else 20000
+    fs20serv = loadScript("fs20-serv.py")
+    print("slow consumer: 20 reading clients, %d clients that never read, %d telegrams" % (stalledCount, telegramCount))
+    for name, serverClass in (("threaded", fs20serv.SocketServer), ("asyncio", fs20serv.AsyncSocketServer)):
+        for policy in fs20serv.OutboundQueue.POLICIES:
+            config = fs20serv.Config()
+            config.overflowPolicy = policy
+            fs20, address = startServer(serverClass, fs20serv, config)
+            clients = connectClients(address, 20)
+            stalled = connectClients(address, stalledCount, recvBufferSize=4096)
+            while len(fs20.clients) < 20 + stalledCount:
+                time.sleep(0.01)
+            receiver = threading.Thread(target=receiveLines, args=(clients, telegramCount, 1))
+            receiver.start()
+            latencies = []
+            for i in range(telegramCount):
+                start = time.perf_counter()
+                fs20.distribute("F404B81%02X" % (i % 256))
+                latencies.append(time.perf_counter() - start)
+            receiver.join()
+            latencies.sort()
+            dropped = sum(client.sendQueue.dropped for client in list(fs20.clients))
+            print("%-8s %-11s distribute() p50 %6.1f us  p99 %7.1f us  max %8.1f us  %6d dropped" % (
+                name, policy, latencies[len(latencies) // 2] * 1e6, latencies[len(latencies) * 99 // 100] * 1e6,
+                latencies[-1] * 1e6, dropped))
+            for sock in clients + stalled:
+                sock.close()
+            while fs20.clients:
+                time.sleep(0.01)
+
+
+def legacyReceiverRead(sock, handle):
+    # the former Fs20Receiver.run loop: 16 bytes per recv(), decoded and appended to a str buffer, one split per
+    # complete line
+    buffer = ''
+    while True:
+        data = sock.recv(16).decode()
+        if len(data) == 0:
+            break
+        buffer += data
+        while '\n' in buffer:
+            telegram, buffer = buffer.split('\n', 1)
+            handle(telegram.replace('\r', ''))
+
+
+def sendBursts(sock, data, seed=1):
+    # chunks of random size, lines split anywhere, from single bytes to many lines at once
+    rng = random.Random(seed)
+    pos = 0
+    while pos < len(data):
+        size = rng.choice((1, 7, 16, 100, 1500, 4096, 20000))
+        sock.sendall(data[pos:pos + size])
+        pos += size
+    sock.shutdown(socket.SHUT_WR)
+
+
+def benchReceiverFraming(args):
+    # fails (exit status 1) if a receiver loses or garbles a line
+    count = int(args[0]) if args else 200000
+    history = loadScript("fs20-osv-history.py")
+    ctrl = loadScript("fs20-osv-ctrl.py")
+    telegrams = ["K31124357", "H155601150100;1760699655.123456;81234.567890", "F404B8111", "!replay 0"]
+    sent = [telegrams[i % len(telegrams)] for i in range(count)]
+    data = "".join("%s\r\n" % telegram for telegram in sent).encode()
+    print("receiver framing: %d lines, %d bytes in bursts of 1 to 20000 bytes" % (count, len(data)))
+
+    failed = []
+    for name, module in (("before (recv(16), split)", None), ("fs20-osv-history readLines", history),
+                         ("fs20-osv-ctrl readLines", ctrl)):
+        received = []
+        reader, writer = socket.socketpair()
+        sender = threading.Thread(target=sendBursts, args=(writer, data))
+        with Timer() as timer:
+            sender.start()
+            if module is None:
+                legacyReceiverRead(reader, received.append)
+            else:
+                receiver = module.Fs20Receiver("localhost:0", NullLogger())
+                receiver.sock = reader
+                receiver.connected = True
+                receiver.notifyHandlers = received.append
+                receiver.readLines()
+            sender.join()
+        reader.close()
+        writer.close()
+        report(name, count, timer, unit="line")
+        if received == sent:
+            print("%-28s all %d lines received intact" % ("", count))
+        else:
+            intact = sum(1 for line in received if line in telegrams)
+            print("%-28s LOST: %d lines received, %d of them intact" % ("", len(received), intact))
+            failed.append(name)
+    if failed:
+        print("lines lost by: %s" % ", ".join(failed))
+        sys.exit(1)
+
+
+class CountingHandler(object):
+    def __init__(self):
+        self.count = 0
+
+    def handle(self, telegram, received=None):
+        self.count += 1
+
+
+def benchDispatch(args):
+    handlerCount = int(args[0]) if args else 500
+    count = int(args[1]) if len(args) > 1 else 200000
+    history = loadScript("fs20-osv-history.py")
+    receiver = history.Fs20Receiver("localhost:0", NullLogger())
+    # HMS100T addresses and S300TH addresses (each with its negative temperature alias)
+    prefixes = ["H%04X" % (0x1000 + i * 7) for i in range(handlerCount - 8)] + ["K%02X" % (0x31 + i) for i in range(8)]
+    handlers = [CountingHandler() for prefix in prefixes]
+    for prefix, handler in zip(prefixes, handlers):
+        receiver.register(prefix, handler)
+    # telegrams for handlers spread over the whole table, the legacy scan finds them half way on average
+    telegrams = []
+    for i in range(count):
+        prefix = prefixes[i * 7919 % len(prefixes)]
+        telegrams.append(prefix + ("01150100" if prefix.startswith("H") else "124357"))
+    print("dispatch: %d handlers (%d prefixes with the K aliases), %d telegrams" % (
+        handlerCount, len(receiver.fs20handler), count))
+
+    with Timer() as timer:
+        for telegram in telegrams:
+            for t in receiver.fs20handler.keys():
+                if telegram.startswith(t):
+                    receiver.fs20handler[t].handle(telegram, None)
+                    break
+    report("before (linear startswith)", count, timer)
+    with Timer() as timer:
+        for telegram in telegrams:
+            receiver.notifyHandlers(telegram)
+    report("after (by prefix length)", count, timer)
+    print("%-28s %d telegrams handled" % ("", sum(handler.count for handler in handlers)))
+
+
+def benchBatchDecode(args):
+    count = int(args[0]) if args else 2000000
+    history = loadScript("fs20-osv-history.py")
+    virtualCul = loadScript("fs20-virtual-cul.py")
+    config = virtualCul.VirtualCulConfig()
+    config.s300th, config.hms100t, config.fs20 = 8, 8, 0
+    generator = virtualCul.simulatedTelegrams(config)
+    print("batch decode: %d S300TH and %d HMS100T telegrams" % (count, count))
+    # handlers only for the convert() reference, their FileWriter writes nothing to its temporary directory
+    targetDir = tempfile.mkdtemp()
+    for kind, decoder, convertBatch in (
+            ("K", history.S300TH("bench", None, NullLogger(), history.FileWriter(targetDir, "K")),
+             history.convertS300THBatch),
+            ("H", history.HMS100T("bench", None, NullLogger(), history.FileWriter(targetDir, "H")),
+             history.convertHMS100TBatch)):
+        sample = []
+        while len(sample) < 10000:
+            telegram = next(generator)
+            if telegram.startswith(kind):
+                sample.append(telegram)
+        telegrams = sample * (count // len(sample)) + sample[:count % len(sample)]
+        with Timer() as timer:
+            scalar = [decoder.convert(telegram) for telegram in telegrams]
+        report("%s convert()" % type(decoder).__name__, count, timer)
+        decoder.stop()
+        with Timer() as timer:
+            batch = convertBatch(telegrams)
+        report("%s()" % convertBatch.__name__, count, timer)
+        # identical values, signed zeros included
+        same = all(list(column) == [row[i] for row in scalar] and
+                   list(history.numpy.signbit(column)) == [history.numpy.signbit(row[i]) for row in scalar]
+                   for i, column in enumerate(batch))
+        print("%-28s %s" % ("", "same values as convert()" if same else "DIFFERENT values than convert()"))
+
+
+def legacyFileWrite(targetDir, prefix, data):
+    # the former FileWriter.write: exists(), open, write and close per row, strftime twice
+    filename = os.path.join(targetDir, "%s-%s.csv" % (prefix, time.strftime("%Y%m%d")))
+    dataKeys = list(data.keys())
+    dataKeys.sort()
+    if os.path.exists(filename):
+        f = open(filename, "a")
+    else:
+        f = open(filename, "w")
+        f.write("time;%s\n" % ";".join(k for k in dataKeys))
+    f.write("%s;" % time.strftime("%Y-%m-%d %H:%M:%S"))
+    f.write("%s\n" % ";".join("%0.2f" % data[k] for k in dataKeys))
+    f.close()
+
+
+def benchFileWriter(args):
+    count = int(args[0]) if args else 100000
+    rooms = 8
+    history = loadScript("fs20-osv-history.py")
+    print("file writer: %d rows spread over %d rooms" % (count, rooms))
+    data = {"temperature": 21.5, "humidity": 45.0}
+    targetDir = tempfile.mkdtemp()
+    with Timer() as timer:
+        for i in range(count):
+            legacyFileWrite(targetDir, "room%d" % (i % rooms), data)
+    report("before (open/close per row)", count, timer, unit="row")
+    for fsync in history.FileWriter.FSYNC:
+        targetDir = tempfile.mkdtemp()
+        writers = [history.FileWriter(targetDir, "room%d" % i, 0.1, fsync) for i in range(rooms)]
+        with Timer() as timer:
+            for i in range(count):
+                writers[i % rooms].write(data)
+            for writer in writers:
+                writer.stop()
+        report("after (fsync %s)" % fsync, count, timer, unit="row")
+
+
+def benchColumnStore(args):
+    days = int(args[0]) if args else 365
+    interval = 180
+    history = loadScript("fs20-osv-history.py")
+    csv2col = loadScript("fs20-csv2col.py")
+    csvDir = tempfile.mkdtemp()
+    start = time.mktime((2025, 1, 1, 0, 0, 0, 0, 0, -1))
+    for day in range(days):
+        dayStart = start + day * 86400
+        f = open(os.path.join(csvDir, "room-%s.csv" % time.strftime("%Y%m%d", time.localtime(dayStart))), "w")
+        f.write("time;humidity;temperature\n")
+        for t in range(int(dayStart), int(dayStart) + 86400, interval):
+            f.write("%s;%0.2f;%0.2f\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), 40 + t % 20, t % 30))
+        f.close()
+    csv2col.convert(csvDir, "room", history)
+    print("column store: %d days, a row every %ds, files in %s" % (days, interval, csvDir))
+
+    def csvQuery(first, last):
+        # mean temperature from the CSV files of the days in the range
+        total, count = 0.0, 0
+        for day in range(int((first - start) // 86400), int((last - start - 1) // 86400) + 1):
+            fileName = os.path.join(csvDir, "room-%s.csv" % time.strftime("%Y%m%d", time.localtime(start + day * 86400)))
+            for timestamp, data in csv2col.csvRows(fileName):
+                if first <= timestamp < last:
+                    total += data["temperature"]
+                    count += 1
+        return count, total / count
+
+    def columnQuery(first, last):
+        temperature = history.ColumnReader(os.path.join(csvDir, "room.col")).range(first, last)["temperature"]
+        return len(temperature), float(temperature.mean(dtype=history.numpy.float64))
+
+    for name, first, last in (("1 day", start + 100 * 86400, start + 101 * 86400),
+                              ("1 week", start + 100 * 86400, start + 107 * 86400),
+                              ("%d days" % days, start, start + days * 86400)):
+        if last > start + days * 86400:
+            continue
+        results = []
+        for kind, query in (("CSV", csvQuery), ("column file", columnQuery)):
+            with Timer() as timer:
+                results.append(query(first, last))
+            print("%-8s %-12s %8d rows  %10.2f ms" % (name, kind, results[-1][0], timer.wall * 1e3))
+        if results[0][0] != results[1][0] or abs(results[0][1] - results[1][1]) > 0.01:
+            print("%-8s DIFFERENT results: %s" % (name, results))
+
+
+def benchRollup(args):
+    days = int(args[0]) if args else 30
+    interval = 10
+    history = loadScript("fs20-osv-history.py")
+    targetDir = tempfile.mkdtemp()
+    start = time.mktime((2025, 3, 1, 0, 0, 0, 0, 0, -1))
+    samples = [(t, {"temperature": (t // 60) % 300 / 10.0 - 5, "humidity": 40 + (t // 7) % 200 / 10.0})
+               for t in range(int(start), int(start + days * 86400), interval)]
+    print("rollup: %d days, a sample every %ds, files in %s" % (days, interval, targetDir))
+    rollup = history.Rollup(targetDir, "room", ["temperature", "humidity"])
+    with Timer() as timer:
+        for t, data in samples:
+            rollup.write(data, t)
+        rollup.stop()
+    report("Rollup.write()", len(samples), timer, unit="sample")
+    # the hourly means against the ones computed from the samples directly
+    hourly = {}
+    for t, data in samples:
+        hour = time.strftime("%Y-%m-%d %H:00:00", time.localtime(t))
+        hourly.setdefault(hour, []).append(data["temperature"])
+    f = open(os.path.join(targetDir, "rollup", "room-1h.csv"))
+    header = f.readline().strip().split(";")
+    rows = [dict(zip(header, line.strip().split(";"))) for line in f]
+    f.close()
+    same = len(rows) == len(hourly) and all(
+        int(row["temperature_count"]) == len(hourly[row["time"]]) and
+        abs(float(row["temperature_mean"]) - sum(hourly[row["time"]]) / len(hourly[row["time"]])) < 0.006
+        for row in rows)
+    print("%-28s %d hourly rows, %s" % ("", len(rows), "same means as the samples" if same else "DIFFERENT means"))
+
+
+def benchReplay(args):
+    count = int(args[0]) if args else 100000
+    speed = 100.0
+    history = loadScript("fs20-osv-history.py")
+    virtualCul = loadScript("fs20-virtual-cul.py")
+    replayScript = loadScript("fs20-replay.py")
+    culConfig = virtualCul.VirtualCulConfig()
+    culConfig.fs20 = 0
+    config = history.Config(None)
+    config.sources = dict(("room%d" % i, prefix) for i, prefix in enumerate(
+        ["K%X" % (0x31 + i) for i in range(culConfig.s300th)] +
+        ["H%04X" % ((0x1556 + i * 0x1111) & 0xFFFF) for i in range(culConfig.hms100t)]))
+    workDir = tempfile.mkdtemp()
+    print("replay: %d telegrams from %d rooms, 10 per second, files in %s" % (count, len(config.sources), workDir))
+    start = time.mktime((2026, 10, 17, 0, 0, 0, 0, 0, -1))
+    archives = []
+    for name, n in (("all", count), ("speed", int(2 * speed * 10))):
+        os.makedirs(os.path.join(workDir, name))
+        archive = history.TelegramArchive(os.path.join(workDir, name), flushInterval=0.1)
+        generator = virtualCul.simulatedTelegrams(culConfig)
+        with Timer() as timer:
+            for i in range(n):
+                archive.write(next(generator), start + i * 0.1)
+            archive.stop()
+        if name == "all":
+            report("TelegramArchive.write()", n, timer)
+            size = sum(os.path.getsize(os.path.join(archive.targetDir, f)) for f in os.listdir(archive.targetDir))
+            print("%-28s %9d bytes, %.1f bytes/telegram" % ("", size, size / float(n)))
+        archives.append(sorted(os.path.join(archive.targetDir, f) for f in os.listdir(archive.targetDir)))
+
+    for name, fileNames, replaySpeed in (("replay (max)", archives[0], 0.0),
+                                         ("replay (%.0fx)" % speed, archives[1], speed)):
+        targetDir = tempfile.mkdtemp(dir=workDir)
+        fs20Receiver = history.Fs20Receiver("replay:0", NullLogger())
+        history.registerHandlers(fs20Receiver, config, replayScript.NullDataServer(), NullLogger(), targetDir)
+        # the handlers print every telegram
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            with Timer() as timer:
+                replayed, elapsed, lag = replayScript.replay(fs20Receiver, fileNames, replaySpeed)
+                fs20Receiver.closeHandlers()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        report(name, replayed, timer)
+        if replaySpeed:
+            print("%-28s %.2fs for %.0fs of telegrams, at most %.1f ms behind schedule" % (
+                "", elapsed, replayed * 0.1, lag * 1e3))
+
+
+class LegacyTcpServer(object):
+    # the former TcpServer.write: a blocking send() to every connection on the caller's thread
+    def __init__(self, connections):
+        self.connections = connections
+
+    def write(self, data):
+        socketsToRemove = []
+        for clientsocket in self.connections:
+            try:
+                clientsocket.send(("%s\n" % data).encode("utf-8"))
+            except Exception:
+                socketsToRemove.append(clientsocket)
+        for socketToRemove in socketsToRemove:
+            self.connections.remove(socketToRemove)
+
+
+def writeLines(server, line, count, latencies, done):
+    # in bursts of 100 lines, about 20000 lines/s
+    for i in range(count):
+        start = time.perf_counter()
+        server.write(line)
+        latencies.append(time.perf_counter() - start)
+        if i % 100 == 99:
+            time.sleep(0.005)
+    done.set()
+
+
+def benchDataServer(args):
+    count = int(args[0]) if args else 100000
+    readers = 10
+    history = loadScript("fs20-osv-history.py")
+    line = json.dumps({"humidity": 45.0, "temperature": 21.5, "room": "Wohnzimmer",
+                       "time": "2026-10-17 12:00:00", "received": 1792231200.123456})
+    print("data server: %d JSON lines to %d reading clients and one that never reads" % (count, readers))
+
+    for name in ("before (blocking send)", "after (selector thread)"):
+        if name.startswith("before"):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            port = listener.getsockname()[1]
+        else:
+            port = freePort()
+            server = history.TcpServer(port, NullLogger(), highWater=4 * 1024 * 1024)
+            server.log = NullLogger().log
+            server.start()
+            waitForPort(port)
+        clients = connectClients(("127.0.0.1", port), readers)
+        stalled = connectClients(("127.0.0.1", port), 1, recvBufferSize=4096)
+        if name.startswith("before"):
+            server = LegacyTcpServer([listener.accept()[0] for i in range(readers + 1)])
+        else:
+            while len(server.connections) < readers + 1:
+                time.sleep(0.01)
+        receiver = threading.Thread(target=receiveLines, args=(clients, count, 2))
+        receiver.start()
+        # the writer is the Fs20Receiver thread: how long does it spend, does it get stuck?
+        latencies = []
+        done = threading.Event()
+        threading.Thread(target=writeLines, args=(server, line, count, latencies, done), daemon=True).start()
+        if not done.wait(count / 10000.0 + 5):
+            print("%-28s writer stuck after %d of %d lines" % (name, len(latencies), count))
+        else:
+            receiver.join()
+            latencies.sort()
+            print("%-28s write() p50 %6.1f us  p99 %7.1f us  max %8.1f us  %d of %d clients still connected" % (
+                name, latencies[len(latencies) // 2] * 1e6, latencies[len(latencies) * 99 // 100] * 1e6,
+                latencies[-1] * 1e6, len(server.connections), readers + 1))
+        for sock in clients + stalled:
+            sock.close()
+
+
+def benchQueries(args):
+    count = int(args[0]) if args else 1000
+    rooms = 8
+    interval = 20
+    history = loadScript("fs20-osv-history.py")
+    csv2col = loadScript("fs20-csv2col.py")
+    targetDir = tempfile.mkdtemp()
+    start = time.mktime((2026, 10, 17, 0, 0, 0, 0, 0, -1))
+    queries = history.RecentQueries(10000, ["temperature", "humidity"])
+    for i in range(rooms):
+        writer = history.FileWriter(targetDir, "room%d" % i, 0.1)
+        recent = queries.room("room%d" % i)
+        for t in range(int(start), int(start) + 86400, interval):
+            data = {"temperature": t % 300 / 10.0, "humidity": 40 + t % 200 / 10.0}
+            writer.write(data, t)
+            recent.write(data, t)
+        writer.stop()
+    print("queries: %d requests for one hour of a room, %d rooms with a sample every %ds for a day" % (
+        count, rooms, interval))
+    first, last = start + 12 * 3600, start + 13 * 3600
+
+    day = time.strftime("%Y%m%d", time.localtime(first))
+    latencies = []
+    for i in range(count):
+        begin = time.perf_counter()
+        fileName = os.path.join(targetDir, "room%d-%s.csv" % (i % rooms, day))
+        rows = [row for row in csv2col.csvRows(fileName) if first <= row[0] < last]
+        latencies.append(time.perf_counter() - begin)
+    print("%-28s %s  %d rows" % ("before (read the CSV file)", percentiles(latencies), len(rows)))
+
+    port = freePort()
+    server = history.TcpServer(port, NullLogger(), queries=queries)
+    server.log = NullLogger().log
+    server.start()
+    waitForPort(port)
+    client = socket.create_connection(("127.0.0.1", port))
+    reader = client.makefile("rb")
+    for name, request in (("after (room ... from ... to)",
+                           lambda i: "room room%d from %.0f to %.0f" % (i % rooms, first, last)),
+                          ("after (latest)", lambda i: "latest")):
+        latencies = []
+        for i in range(count):
+            begin = time.perf_counter()
+            client.sendall(("%s\n" % request(i)).encode())
+            reply = json.loads(reader.readline())
+            latencies.append(time.perf_counter() - begin)
+        size = len(reply["time"]) if "time" in reply else len(reply["rooms"])
+        print("%-28s %s  %d %s" % (name, percentiles(latencies), size, "rows" if "time" in reply else "rooms"))
+    client.close()
+
+
+class LegacyLogger(object):
+    # the former Logger.log: two strftime calls, a write and a flush per line on the calling thread
+    def __init__(self, logPrefix):
+        self.logPrefix = logPrefix
+        self.date = time.strftime("%Y-%m-%d")
+        self.logFile = open(self.logPrefix + "." + self.date, "a")
+
+    def log(self, str):
+        date = time.strftime("%Y-%m-%d")
+        if date != self.date:
+            self.date = date
+        self.logFile.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), str))
+        self.logFile.flush()
+
+    def stop(self):
+        self.logFile.close()
+
+
+def benchLogger(args):
+    count = int(args[0]) if args else 200000
+    fs20serv = loadScript("fs20-serv.py")
+    logDir = tempfile.mkdtemp()
+    print("logger: %d lines, time and CPU spent in the calling thread, log files in %s" % (count, logDir))
+    for name, loggerClass in (("before (sync write+flush)", LegacyLogger), ("after (queued, batched)", fs20serv.Logger)):
+        logger = loggerClass(os.path.join(logDir, loggerClass.__name__))
+        with Timer() as caller:
+            for i in range(count):
+                logger.log("Fs20: received FS20 telegram F404B81%02X" % (i % 256))
+        start = time.perf_counter()
+        logger.stop()
+        report(name, count, caller, unit="line", threadCpu=True)
+        print("%-28s %9.3f s until everything was written, %.2f us CPU/line in all threads" % (
+            "", caller.wall + time.perf_counter() - start, caller.cpu * 1e6 / count))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "no samples"
+    return "p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms  max %7.1f ms  (%d samples)" % (
+        values[len(values) // 2] * 1e3, values[len(values) * 9 // 10] * 1e3, values[len(values) * 99 // 100] * 1e3,
+        values[-1] * 1e3, len(values))
+
+
+class InfluxSink(http.server.BaseHTTPRequestHandler):
+    # stands in for InfluxDB's /api/v2/write: keeps the arrival time and the timestamp of every point
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        precision = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get("precision", ["ns"])[0]
+        scale = {"s": 1, "ms": 1e3, "us": 1e6, "ns": 1e9}.get(precision, 1e9)
+        now = time.time()
+        for line in body.splitlines():
+            if line.strip():
+                self.server.points.append((now, int(line.rsplit(" ", 1)[1]) / scale))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def waitForPort(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def freePort():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def benchEndToEnd(args):
+    # fs20-serv, fs20-osv-history and fs20-influx-bridge as separate processes against a virtual CUL and a fake
+    # InfluxDB; latencies: CUL to an fs20-serv client, fs20-serv's serial read to InfluxDB, client command to CUL
+    seconds = float(args[0]) if args else 30
+    rate = float(args[1]) if len(args) > 1 else 20
+    txRate = float(args[2]) if len(args) > 2 else 0.2
+    virtualCul = loadScript("fs20-virtual-cul.py")
+    workDir = tempfile.mkdtemp()
+    here = os.path.dirname(os.path.abspath(__file__))
+    print("end to end: %.0fs, %.1f telegrams/s from the virtual CUL, %.1f commands/s to it, files in %s" % (
+        seconds, rate, txRate, workDir))
+
+    culConfig = virtualCul.VirtualCulConfig()
+    culConfig.rate = rate
+    cul = virtualCul.VirtualCul(culConfig)
+    emitted = collections.defaultdict(collections.deque)
+    cul.onEmit = lambda telegram, when: emitted[telegram].append(when)
+
+    sink = http.server.ThreadingHTTPServer(("127.0.0.1", 0), InfluxSink)
+    sink.daemon_threads = True
+    sink.points = []
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+    servPort, dataPort = freePort(), freePort()
+    rooms = dict(("room%d" % i, prefix) for i, prefix in enumerate(
+        ["K%X" % (0x31 + i) for i in range(culConfig.s300th)] +
+        ["H%04X" % ((0x1556 + i * 0x1111) & 0xFFFF) for i in range(culConfig.hms100t)]))
+    files = {
+        "serv": "logPrefix: %s\nserver: asyncio\n" % os.path.join(workDir, "fs20"),
+        "history": "sources: %s\nlogPrefix: %s\ndataDir: %s\n" % (
+            json.dumps(rooms), os.path.join(workDir, "fs20-osv-history"), os.path.join(workDir, "data")),
+        "influx": "bucket: bench\nurl: http://127.0.0.1:%d\ntoken: bench\norg: bench\nmeasurement: house\n"
+                  "tagname: entity\nsources: %s\n" % (sink.server_address[1],
+                                                      json.dumps({"fs20": "127.0.0.1:%d" % dataPort})),
+    }
+    for name, content in files.items():
+        with open(os.path.join(workDir, name + ".conf"), "w") as f:
+            f.write(content)
+
+    processes = []
+    try:
+        for command, port in (
+                (["fs20-serv.py", "--config", os.path.join(workDir, "serv.conf"), str(servPort), cul.path], servPort),
+                (["fs20-osv-history.py", "127.0.0.1:%d" % servPort, str(dataPort), os.path.join(workDir, "history.conf")],
+                 dataPort),
+                (["fs20-influx-bridge.py", os.path.join(workDir, "influx.conf")], None)):
+            output = open(os.path.join(workDir, command[0] + ".out"), "w")
+            processes.append(subprocess.Popen([sys.executable, os.path.join(here, command[0])] + command[1:],
+                                              stdout=output, stderr=subprocess.STDOUT))
+            if port and not waitForPort(port):
+                print("%s did not start, see %s" % (command[0], output.name))
+                return
+
+        client = socket.create_connection(("127.0.0.1", servPort))
+        client.sendall(b"!timestamps\n")
+        clientLatency = []
+        servLatency = []
+        received = [0]
+        replies = {}
+
+        def receive():
+            buffer = b""
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                now = time.monotonic()
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    telegram, separator, stamp = line.decode().partition(";")
+                    if telegram.startswith("!"):
+                        replies[telegram.split()[0]] = telegram
+                    if not separator or telegram in commands:
+                        continue
+                    received[0] += 1
+                    servLatency.append(now - float(stamp.split(";")[1]))
+                    # the latest report of this telegram, earlier ones were dropped by fs20-serv as repeats
+                    if emitted[telegram]:
+                        clientLatency.append(now - emitted[telegram][-1])
+                        emitted[telegram].clear()
+
+        commands = {}
+        threading.Thread(target=receive, daemon=True).start()
+        cul.start()
+        start = time.monotonic()
+        nextCommand = start
+        while time.monotonic() - start < seconds:
+            if txRate > 0 and time.monotonic() >= nextCommand:
+                telegram = "F404B%02X%02X" % (0x81 + len(commands) % 8, 0x11 if len(commands) % 2 else 0x00)
+                commands.setdefault(telegram, collections.deque()).append(time.monotonic())
+                client.sendall(("%s\n" % telegram).encode())
+                nextCommand += 1.0 / txRate
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        cul.stop()
+        # give everything in flight a moment to come through
+        time.sleep(2)
+        client.sendall(b"!dedup\n")
+        time.sleep(0.5)
+        suppressed = json.loads(replies["!dedup"].split(" ", 1)[1])["suppressed"] if "!dedup" in replies else 0
+
+        txLatency = []
+        for when, telegram in list(cul.transmitted):
+            if commands.get(telegram):
+                txLatency.append(when - commands[telegram].popleft())
+        sensorCount = sum(1 for i in range(cul.emitted) if i % (len(rooms) + culConfig.fs20) < len(rooms))
+        influxLatency = [arrival - stamp for arrival, stamp in sink.points]
+        print("%-28s %9d telegrams  %8.1f telegrams/s" % ("virtual CUL reported", cul.emitted, cul.emitted / elapsed))
+        print("%-28s %9d telegrams  %8.1f telegrams/s  (%d dropped as repeats)" % (
+            "fs20-serv client received", received[0], received[0] / elapsed, suppressed))
+        print("%-28s %9d points     %8.1f points/s  (of %d sensor telegrams)" % (
+            "InfluxDB received", len(sink.points), len(sink.points) / elapsed, sensorCount))
+        print("%-28s %9d LOVF" % ("virtual CUL", cul.lovfCount))
+        print("%-28s %s" % ("CUL -> fs20-serv client", percentiles(clientLatency)))
+        print("%-28s %s" % ("inside fs20-serv", percentiles(servLatency)))
+        print("%-28s %s" % ("fs20-serv read -> InfluxDB", percentiles(influxLatency)))
+        print("%-28s %s" % ("client command -> CUL", percentiles(txLatency)))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        sink.shutdown()
+
+
+BENCHMARKS = {
+    "end-to-end": (benchEndToEnd, "[seconds] [telegrams/s] [commands/s]"),
+    "batch-decode": (benchBatchDecode, "[telegrams]"),
+    "column-store": (benchColumnStore, "[days]"),
+    "data-server": (benchDataServer, "[lines]"),
+    "dispatch": (benchDispatch, "[handlers] [telegrams]"),
+    "file-writer": (benchFileWriter, "[rows]"),
+    "logger": (benchLogger, "[lines]"),
+    "replay": (benchReplay, "[telegrams]"),
+    "rollup": (benchRollup, "[days]"),
+    "queries": (benchQueries, "[requests]"),
+    "receiver-framing": (benchReceiverFraming, "[lines]"),
+    "serial-reader": (benchSerialReader, "[telegrams] [bytes per burst]"),
+    "slow-consumer": (benchSlowConsumer, "[stalled clients] [telegrams]"),
+    "socket-server": (benchSocketServer, "[clients] [telegrams]"),
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: %s <benchmark> [args]" % sys.argv[0])
+        for name, (fn, usage) in sorted(BENCHMARKS.items()):
+            print("       %s %s %s" % (sys.argv[0], name, usage))
+        sys.exit(-1)
+    BENCHMARKS[sys.argv[1]][0](sys.argv[2:])
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import time
+
+from scriptloader import loadScript
+
+
+def csvRows(filename):
+    # (time, {column: value}) per row of a fs20-osv-history CSV file; rows that fit neither the header nor one of
+    # the shapes below are skipped and counted on stderr
+    f = open(filename, "r")
+    header = f.readline().strip().split(";")[1:]
+    second = None
+    timestamp = 0.0
+    skipped = 0
+    for line in f:
+        fields = line.strip().split(";")
+        if len(fields) < 2:
+            continue
+        if fields[0] != second:
+            second = fields[0]
+            timestamp = time.mktime(time.strptime(second, "%Y-%m-%d %H:%M:%S"))
+        values = [float(v) for v in fields[1:]]
+        if len(values) == len(header):
+            yield timestamp, dict(zip(header, values))
+        elif len(values) == 1:
+            # HMS100T rows without humidity only have the temperature, written under the full header
+            yield timestamp, {"temperature": values[0]}
+        elif len(values) == 2:
+            # and the other way round: the day's first row had no humidity, so the header only has the temperature
+            yield timestamp, {"humidity": values[0], "temperature": values[1]}
+        else:
+            skipped += 1
+    f.close()
+    if skipped:
+        sys.stderr.write("%s: skipped %d rows that do not fit the header %s\n" % (filename, skipped, ";".join(header)))
+
+
+def convert(csvDir, room, history):
+    # exactly <room>-YYYYMMDD.csv: "Bad-OG-20260101.csv" is not one of Bad's, and mixing it in would break the
+    # time order ColumnReader searches in
+    pattern = re.compile(re.escape(room) + r"-\d{8}\.csv$")
+    fileNames = sorted(fileName for fileName in os.listdir(csvDir) if pattern.match(fileName))
+    target = os.path.join(csvDir, room + ".col")
+    if os.path.exists(target):
+        print("%s exists, not converting %s" % (target, room))
+        return
+    writer = history.ColumnWriter(target, ["temperature", "humidity"])
+    count = 0
+    for fileName in fileNames:
+        for timestamp, data in csvRows(os.path.join(csvDir, fileName)):
+            writer.write(data, timestamp)
+            count += 1
+    writer.close(True)
+    print("%s: %d rows from %d files written to %s" % (room, count, len(fileNames), target))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: %s <csv-dir> <room> [<room> ...]" % sys.argv[0])
+        print("ex:    %s /tmp/fs20 Aussen Wohnzimmer" % sys.argv[0])
+        print("")
+        print("converts <csv-dir>/<room>-YYYYMMDD.csv to <csv-dir>/<room>.col, the column file fs20-osv-history")
+        print("writes with 'columnStore: on'; stop fs20-osv-history first, existing column files are left alone")
+        sys.exit(-1)
+    history = loadScript("fs20-osv-history.py")
+    for room in sys.argv[2:]:
+        convert(sys.argv[1], room, history)
@@ -129,11 +129,15 @@ class InfluxLink(object):
             self.client = InfluxDBClient(url=self.config.url, token=self.config.token, org=self.config.org)
         write_api = self.client.write_api(write_options=SYNCHRONOUS)
         p = Point(self.config.measurement)
-        t = datetime.datetime.fromisoformat(dataPoint["time"]).astimezone()
-        p.time(t, WritePrecision.S)
+        if "received" in dataPoint:
+            # seconds since the epoch, to the microsecond
+            t = datetime.datetime.fromtimestamp(dataPoint["received"]).astimezone()
+        else:
+            t = datetime.datetime.fromisoformat(dataPoint["time"]).astimezone()
+        p.time(t, WritePrecision.US)
         p.tag(self.config.tagname, tag)
         for k, v in dataPoint.items():
-            if k == "time":
+            if k in ("time", "received"):
                 pass
             elif k == "room":
                 p.field(k.strip(), v)
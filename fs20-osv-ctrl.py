@@ -2,9 +2,12 @@
 # -*- coding: iso-8859-1 -*-
 
 import socket
+import collections
+import atexit
 import threading
 import time
 import os
+import signal
 import sys
 import ephem
 import datetime
@@ -15,31 +18,104 @@ except:
     GPIO = None
 
 
-class Logger(object):
-    def __init__(self, logPrefix):
+class Logger(threading.Thread):
+    # log() only appends the line to a deque; a background thread formats, writes and flushes the lines in batches,
+    # every flushInterval seconds or as soon as flushSize lines are waiting. At most maxRecords lines wait, the
+    # oldest are dropped (and counted) when the thread cannot keep up or cannot write
+    def __init__(self, logPrefix, flushInterval=1.0, flushSize=500, maxRecords=100000):
+        super(Logger, self).__init__()
+        self.daemon = True
         self.logPrefix = logPrefix
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.records = collections.deque(maxlen=maxRecords)
+        self.dropped = 0
+        # the error the last batch failed with, reported once until a batch is written again
+        self.failure = None
+        self.wakeup = threading.Event()
+        self.running = True
         self.date = time.strftime("%Y-%m-%d")
+        self.second = None
+        self.timestamp = ""
         self.logFile = open(self.logPrefix + "." + self.date, "a")
+        self.start()
+        # the thread is a daemon: write what is still waiting when the process exits without stop()
+        atexit.register(self.stop)
 
     def log(self, str):
-        date = time.strftime("%Y-%m-%d")
-        if date != self.date:
-            self.logFile.write("%s starting new logfile" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            self.logFile.close()
-            self.date = date
-            self.logFile = open(self.logPrefix + "." + self.date, "w")
-            self.logFile.write("%s starting new logfile" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(time.time() - 2 * 86400))
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), str))
+        if len(self.records) >= self.flushSize:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running or self.records:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            if not self.records:
+                continue
+            # take the batch off the deque first: log() evicts records[0] once the deque is full
+            batch = [self.records.popleft() for i in range(len(self.records))]
+            written = 0
             try:
-                os.remove(oldLogFileName)
+                if self.logFile.closed:
+                    # a rotation or an earlier batch failed before a new file was open
+                    self.logFile = open(self.logPrefix + "." + self.date, "a")
+                for record in batch:
+                    self.write(*record)
+                    written += 1
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.logFile.write("%s %d log lines dropped\n" % (self.timestamp, dropped))
+                self.logFile.flush()
+                self.failure = None
             except Exception as exc:
-                self.logFile.write("%s cannot delete old log file %s: %s" % (
-                    time.strftime('%Y-%m-%d %H:%M:%S'), oldLogFileName, exc))
-        self.logFile.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), str))
-        self.logFile.flush()
+                # disk full, permissions: keep the lines and try again with the next batch
+                if self.failure is None:
+                    sys.stderr.write("Logger: cannot write to %s: %s\n" % (self.logPrefix, exc))
+                self.failure = exc
+                # the unwritten lines go back in front of the ones logged meanwhile
+                for record in reversed(batch[written:]):
+                    if len(self.records) == self.records.maxlen:
+                        self.dropped += 1
+                    self.records.appendleft(record)
+                if not self.running:
+                    break
+        try:
+            self.logFile.close()
+        except Exception:
+            pass
+
+    def write(self, timestamp, str):
+        # strftime once per second instead of twice per line
+        second = int(timestamp)
+        if second != self.second:
+            self.second = second
+            self.timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            if self.timestamp[:10] != self.date:
+                self.rotate(self.timestamp[:10], second)
+        self.logFile.write("%s %s\n" % (self.timestamp, str))
+
+    def rotate(self, date, second):
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
+        self.logFile.close()
+        self.date = date
+        self.logFile = open(self.logPrefix + "." + self.date, "w")
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
+        oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(second - 2 * 86400))
+        try:
+            os.remove(oldLogFileName)
+        except Exception as exc:
+            self.logFile.write("%s cannot delete old log file %s: %s\n" % (self.timestamp, oldLogFileName, exc))
 
     def stop(self):
-        self.logFile.close()
+        # writes and flushes everything logged so far; called again at exit, which does nothing then
+        if not self.is_alive():
+            return
+        self.running = False
+        self.wakeup.set()
+        self.join(5)
 
 
 class Fs20Receiver(threading.Thread):
@@ -51,6 +127,8 @@ class Fs20Receiver(threading.Thread):
         self.serverPort = int(serverName.split(':')[1])
         self.connected = False
         self.fs20handler = {}
+        # distinct lengths of the registered prefixes, longest first: a telegram needs one dict lookup per length
+        self.prefixLengths = []
 
     def connect(self):
         while not self.connected:
@@ -58,46 +136,54 @@ class Fs20Receiver(threading.Thread):
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.serverIp, self.serverPort))
                 self.connected = True
+                self.subscribe()
             except Exception as exc:
                 print(exc)
                 self.log("failed to connect to FS20 server: %s" % exc)
                 time.sleep(5)
 
-    def send(self, telegram):
+    def send(self, telegram, priority=None):
+        # priority: "interactive", "normal" or "bulk", fs20-serv sends more urgent telegrams first
         if self.connected:
             self.log("sending %s" % telegram)
+            if priority:
+                telegram = "%s:%s" % (priority, telegram)
             self.sock.send((telegram + '\n').encode())
         else:
             self.log("not sending %s, no connection (yet)" % telegram)
 
-    def sendList(self, telegramList):
+    def subscribe(self):
+        # let fs20-serv only pass the telegrams there is a handler for
+        if self.fs20handler:
+            self.sock.send(("!subscribe %s\n" % " ".join(sorted(self.fs20handler))).encode())
+
+    def sendList(self, telegramList, priority=None):
         for telegram in telegramList:
-            self.send(telegram)
+            self.send(telegram, priority)
 
     def run(self):
         self.log("started")
         while True:
             self.connect()
-            buffer = ''
-            telegram = ''
-            while self.connected:
-                try:
-                    buffer += self.sock.recv(16).decode()
-                    if len(buffer) == 0:
-                        self.connected = False
-                        break
-                    if '\n' in buffer:
-                        telegram += buffer.split('\n')[0]
-                        telegram = telegram.replace('\r', '')
-                        self.notifyHandlers(telegram)
-                        telegram = ''
-                    if len(buffer.split('\n')) > 1:
-                        buffer = buffer.split('\n')[1]
-                    else:
-                        buffer = ''
-                except KeyboardInterrupt:
-                    self.log("caught KeyboardInterrupt, exiting")
-                    sys.exit(0)
+            try:
+                self.readLines()
+            except KeyboardInterrupt:
+                self.log("caught KeyboardInterrupt, exiting")
+                sys.exit(0)
+
+    def readLines(self):
+        # until the connection is closed: everything the socket has (up to 4096 bytes) per recv(), any number of
+        # lines per chunk, the unfinished line stays in the buffer; every line is decoded once
+        buffer = b''
+        while self.connected:
+            data = self.sock.recv(4096)
+            if not data:
+                self.connected = False
+                break
+            lines = (buffer + data).split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                self.notifyHandlers(line.rstrip(b'\r').decode())
 
     #				except Exception as exc:
     #					self.log("caught exception " + exc.message)
@@ -105,13 +191,19 @@ class Fs20Receiver(threading.Thread):
     #					break
 
     def notifyHandlers(self, telegram):
-        for telegramPrefix in self.fs20handler:
-            if telegramPrefix in telegram:
-                self.fs20handler[telegramPrefix].handle(telegram)
+        if telegram.startswith("!"):
+            self.log("server replied '%s'" % telegram)
+            return
+        for n in self.prefixLengths:
+            handler = self.fs20handler.get(telegram[:n])
+            if handler is not None:
+                handler.handle(telegram)
                 return
 
     def register(self, telegram, handler):
+        # telegram: the start of the telegrams for this handler, type, housecode and address, e.g. "F404B00"
         self.fs20handler[telegram] = handler
+        self.prefixLengths = sorted(set(len(t) for t in self.fs20handler), reverse=True)
 
     def log(self, logStr):
         self.logger.log("Fs20Receiver: " + logStr)
@@ -296,26 +388,26 @@ class Controller(object):
             # self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511", "F404B8611", "F404B8711", "F404B8811", "F404B8911"])
             self.fs20Receiver.sendList(
                 ["F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511", "F404B8611", "F404B8711",
-                 "F404B8811"])
+                 "F404B8811"], "bulk")
         else:
             self.log("Morgens/anwesend")
-            self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511"])
+            self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511"], "bulk")
 
     def schoolday(self, param):
         if not (self.modeMonitor.isFullyActive()):
             if (datetime.datetime.today().weekday() <= 4):
-                self.fs20Receiver.sendList("F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511")
+                self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8311", "F404B9011", "F404B8511"], "bulk")
 
     def suedSchatten(self, param):
         if ("start" in param):
             if (self.modeMonitor.sunnyDay):
                 self.log("vormittag, sonnig, Beschattung Suedseite")
-                self.fs20Receiver.sendList(["F404B81202D", "F404B82202D", "F404B872044"])
+                self.fs20Receiver.sendList(["F404B81202D", "F404B82202D", "F404B872044"], "bulk")
         # self.fs20Receiver.sendList(["F404B81202D", "F404B82202D", "F404B872044", "F404B892044"])
         if ("end" in param):
             if (self.modeMonitor.sunnyDay):
                 self.log("Ende Beschattung Suedseite")
-                self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8711"])
+                self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8711"], "bulk")
 
     # self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8711", "F404B8911"])
 
@@ -327,14 +419,14 @@ class Controller(object):
             self.log("Nachmittags/Haus unbewohnt")
             if (self.modeMonitor.sunnyDay):
                 self.log("sonnig, Wohnzimmer verdunkeln")
-                self.fs20Receiver.sendList(["F404B832045", "F404B902045", "F404B852045"])
+                self.fs20Receiver.sendList(["F404B832045", "F404B902045", "F404B852045"], "bulk")
             else:
                 self.log("keine Sonne")
         else:
             self.log("Nachmittags/anwesend")
             if (self.modeMonitor.sunnyDay):
                 self.log("sonnig, Wohnzimmer beschatten")
-                self.fs20Receiver.sendList(["F404B832045", "F404B902045", "F404B852045"])
+                self.fs20Receiver.sendList(["F404B832045", "F404B902045", "F404B852045"], "bulk")
             # self.fs20Receiver.sendList(["F404B832074", "F404B852074"])
             else:
                 self.log("keine Sonne")
@@ -357,7 +449,7 @@ class Controller(object):
 
     def evening(self, param):
         self.log("Abends")
-        self.fs20Receiver.sendList(["F404B8311", "F404B9011", "F404B8511"])
+        self.fs20Receiver.sendList(["F404B8311", "F404B9011", "F404B8511"], "bulk")
 
     def night(self, param):
         if (self.modeMonitor.isFullyActive()):
@@ -365,10 +457,10 @@ class Controller(object):
             # self.fs20Receiver.sendList(["F404B8100", "F404B8200", "F404B8300", "F404B9000", "F404B8500", "F404B8600", "F404B8700", "F404B8800", "F404B8900"])
             self.fs20Receiver.sendList(
                 ["F404B8100", "F404B8200", "F404B8300", "F404B9000", "F404B8500", "F404B8600", "F404B8700",
-                 "F404B8800"])
+                 "F404B8800"], "bulk")
         else:
             self.log("Nachts/anwesend")
-            self.fs20Receiver.sendList(["F404B8100", "F404B8200", "F404B8300", "F404B9000", "F404B8500"])
+            self.fs20Receiver.sendList(["F404B8100", "F404B8200", "F404B8300", "F404B9000", "F404B8500"], "bulk")
 
     # self.fs20Receiver.sendList(["F404B8100"])
 
@@ -392,12 +484,12 @@ class LightsControl(object):
             self.fs20Receiver.sendList(["F404B0111", "F404B0211", "F404B0311",
                                         "F404B0411", "F404B0511", "F404B0611", "F404B0711", "F404B0811",
                                         "F404B0911", "F404B0A11", "F404B0B11", "F404B0C11", "F404B0D11",
-                                        "F404B0E11", "F404B0F11"])
+                                        "F404B0E11", "F404B0F11"], "interactive")
         elif "F404B0000" in telegram:
             self.fs20Receiver.sendList(["F404B0100", "F404B0200", "F404B0300",
                                         "F404B0400", "F404B0500", "F404B0600", "F404B0700", "F404B0800",
                                         "F404B0900", "F404B0A00", "F404B0B00", "F404B0C00", "F404B0D00",
-                                        "F404B0E00", "F404B0F00"])
+                                        "F404B0E00", "F404B0F00"], "interactive")
 
 
 class BlindsControl(object):
@@ -409,11 +501,11 @@ class BlindsControl(object):
         if "F404B8011" in telegram:
             self.fs20Receiver.sendList(["F404B8111", "F404B8211", "F404B8311",
                                         "F404B9011", "F404B8511", "F404B8611", "F404B8711", "F404B8811",
-                                        "F404B8911"])
+                                        "F404B8911"], "interactive")
         elif "F404B8000" in telegram:
             self.fs20Receiver.sendList(["F404B8100", "F404B8200", "F404B8300",
                                         "F404B9000", "F404B8500", "F404B8600", "F404B8700", "F404B8800",
-                                        "F404B8900"])
+                                        "F404B8900"], "interactive")
 
 
 if __name__ == '__main__':
@@ -582,6 +674,11 @@ if __name__ == '__main__':
 
     timeController.start()
 
+    def terminate(signum, frame):
+        # systemd stop, kill: shut down as on Ctrl-C, which writes out what the Logger still holds
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
     fs20Receiver.run()
 
 # F5E7E133100 = Sonne
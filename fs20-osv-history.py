@@ -1,43 +1,124 @@
 #!/usr/bin/python3
 # -*- coding: iso-8859-1 -*-
 
+import array
+import atexit
+import collections
+import gzip
 import socket
 import threading
 import time
 import os
+import selectors
+import signal
+import struct
 import sys
 import json
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class Logger(object):
-    def __init__(self, logPrefix):
+
+class Logger(threading.Thread):
+    # log() only appends the line to a deque; a background thread formats, writes and flushes the lines in batches,
+    # every flushInterval seconds or as soon as flushSize lines are waiting. At most maxRecords lines wait, the
+    # oldest are dropped (and counted) when the thread cannot keep up or cannot write
+    def __init__(self, logPrefix, flushInterval=1.0, flushSize=500, maxRecords=100000):
+        super(Logger, self).__init__()
+        self.daemon = True
         self.logPrefix = logPrefix
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.records = collections.deque(maxlen=maxRecords)
+        self.dropped = 0
+        # the error the last batch failed with, reported once until a batch is written again
+        self.failure = None
+        self.wakeup = threading.Event()
+        self.running = True
         self.date = time.strftime("%Y-%m-%d")
-        filename = "%s.%s" % (self.logPrefix, self.date)
-        if os.path.exists(filename):
-            self.logFile = open(filename, "a")
-        else:
-            self.logFile = open(filename, "w")
+        self.second = None
+        self.timestamp = ""
+        self.logFile = open(self.logPrefix + "." + self.date, "a")
+        self.start()
+        # the thread is a daemon: write what is still waiting when the process exits without stop()
+        atexit.register(self.stop)
 
     def log(self, str):
-        date = time.strftime("%Y-%m-%d")
-        if date != self.date:
-            self.logFile.write("%s starting new logfile\n" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            self.logFile.close()
-            self.date = date
-            self.logFile = open("%s.%s" % (self.logPrefix, self.date), "w")
-            self.logFile.write("%s starting new logfile\n" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(time.time() - 2 * 86400))
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), str))
+        if len(self.records) >= self.flushSize:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running or self.records:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            if not self.records:
+                continue
+            # take the batch off the deque first: log() evicts records[0] once the deque is full
+            batch = [self.records.popleft() for i in range(len(self.records))]
+            written = 0
             try:
-                os.remove(oldLogFileName)
+                if self.logFile.closed:
+                    # a rotation or an earlier batch failed before a new file was open
+                    self.logFile = open(self.logPrefix + "." + self.date, "a")
+                for record in batch:
+                    self.write(*record)
+                    written += 1
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.logFile.write("%s %d log lines dropped\n" % (self.timestamp, dropped))
+                self.logFile.flush()
+                self.failure = None
             except Exception as exc:
-                self.logFile.write("%s cannot delete old log file %s: %s\n" % (
-                    time.strftime('%Y-%m-%d %H:%M:%S'), oldLogFileName, exc))
-        self.logFile.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), str))
-        self.logFile.flush()
+                # disk full, permissions: keep the lines and try again with the next batch
+                if self.failure is None:
+                    sys.stderr.write("Logger: cannot write to %s: %s\n" % (self.logPrefix, exc))
+                self.failure = exc
+                # the unwritten lines go back in front of the ones logged meanwhile
+                for record in reversed(batch[written:]):
+                    if len(self.records) == self.records.maxlen:
+                        self.dropped += 1
+                    self.records.appendleft(record)
+                if not self.running:
+                    break
+        try:
+            self.logFile.close()
+        except Exception:
+            pass
 
-    def stop(self):
+    def write(self, timestamp, str):
+        # strftime once per second instead of twice per line
+        second = int(timestamp)
+        if second != self.second:
+            self.second = second
+            self.timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            if self.timestamp[:10] != self.date:
+                self.rotate(self.timestamp[:10], second)
+        self.logFile.write("%s %s\n" % (self.timestamp, str))
+
+    def rotate(self, date, second):
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
         self.logFile.close()
+        self.date = date
+        self.logFile = open(self.logPrefix + "." + self.date, "w")
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
+        oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(second - 2 * 86400))
+        try:
+            os.remove(oldLogFileName)
+        except Exception as exc:
+            self.logFile.write("%s cannot delete old log file %s: %s\n" % (self.timestamp, oldLogFileName, exc))
+
+    def stop(self):
+        # writes and flushes everything logged so far; called again at exit, which does nothing then
+        if not self.is_alive():
+            return
+        self.running = False
+        self.wakeup.set()
+        self.join(5)
 
 
 class Fs20Receiver(threading.Thread):
@@ -49,6 +130,15 @@ class Fs20Receiver(threading.Thread):
         self.serverPort = int(serverName.split(':')[1])
         self.connected = False
         self.fs20handler = {}
+        # distinct lengths of the registered prefixes, longest first: a telegram needs one dict lookup per length
+        self.prefixLengths = []
+        # receive time of the last telegram handled, what was missed while disconnected is replayed from there
+        self.lastReceived = None
+        # (telegram, stamp) of the last telegrams handled: a replayed telegram that also came live is dropped
+        self.handled = collections.OrderedDict()
+        self.handledSize = 1000
+        # a TelegramArchive, every telegram goes there before it is handled
+        self.archive = None
 
     def connect(self):
         while not self.connected:
@@ -56,6 +146,7 @@ class Fs20Receiver(threading.Thread):
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.serverIp, self.serverPort))
                 self.connected = True
+                self.subscribe()
             except Exception as exc:
                 print(exc)
                 self.log("failed to connect to FS20 server: %s" % exc)
@@ -64,10 +155,19 @@ class Fs20Receiver(threading.Thread):
     def send(self, telegram):
         if self.connected:
             self.log("sending %s" % telegram)
-            self.sock.send(telegram + '\n')
+            self.sock.send((telegram + '\n').encode())
         else:
             self.log("not sending %s, no connection (yet)" % telegram)
 
+    def subscribe(self):
+        # let fs20-serv only pass the telegrams there is a handler for, with the time they were received; stamps
+        # first, so every telegram handled can be told apart from its replayed copy
+        self.sock.send("!timestamps\n".encode())
+        if self.fs20handler:
+            self.sock.send(("!subscribe %s\n" % " ".join(sorted(self.fs20handler))).encode())
+        if self.lastReceived is not None:
+            self.sock.send(("!replay since %.6f\n" % (self.lastReceived + 0.000001)).encode())
+
     def sendList(self, telegramList):
         for telegram in telegramList:
             self.send(telegram)
@@ -75,28 +175,28 @@ class Fs20Receiver(threading.Thread):
     def run(self):
         self.log("started")
         while True:
-            self.connect()
-            buffer = ''
-            telegram = ''
-            while self.connected:
-                try:
-                    buffer += self.sock.recv(16).decode()
-                    if len(buffer) == 0:
-                        self.connected = False
-                        break
-                    if '\n' in buffer:
-                        telegram += buffer.split('\n')[0]
-                        telegram = telegram.replace('\r', '')
-                        self.notifyHandlers(telegram)
-                        telegram = ''
-                    if len(buffer.split('\n')) > 1:
-                        buffer = buffer.split('\n')[1]
-                    else:
-                        buffer = ''
-                except KeyboardInterrupt:
-                    self.log("caught KeyboardInterrupt, exiting")
-                    self.closeHandlers()
-                    sys.exit(0)
+            try:
+                self.connect()
+                self.readLines()
+            except KeyboardInterrupt:
+                self.log("caught KeyboardInterrupt, exiting")
+                self.closeHandlers()
+                self.logger.stop()
+                sys.exit(0)
+
+    def readLines(self):
+        # until the connection is closed: everything the socket has (up to 4096 bytes) per recv(), any number of
+        # lines per chunk, the unfinished line stays in the buffer; every line is decoded once
+        buffer = b''
+        while self.connected:
+            data = self.sock.recv(4096)
+            if not data:
+                self.connected = False
+                break
+            lines = (buffer + data).split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                self.notifyHandlers(line.rstrip(b'\r').decode())
 
     #				except Exception as exc:
     #					self.log("caught exception " + exc.message)
@@ -104,9 +204,27 @@ class Fs20Receiver(threading.Thread):
     #					break
 
     def notifyHandlers(self, telegram):
-        for t in self.fs20handler.keys():
-            if telegram.startswith(t):
-                self.fs20handler[t].handle(telegram)
+        if telegram.startswith("!"):
+            self.log("server replied '%s'" % telegram)
+            return False
+        # "K31124357;1760699655.123456;81234.567890": telegram, wall clock and monotonic time it was received
+        telegram, separator, stamp = telegram.partition(";")
+        received = float(stamp.split(";")[0]) if separator else None
+        if received is not None:
+            key = (telegram, stamp)
+            if key in self.handled:
+                self.log("already handled telegram '%s' received at %.6f" % (telegram, received))
+                return False
+            self.handled[key] = True
+            if len(self.handled) > self.handledSize:
+                self.handled.popitem(last=False)
+            self.lastReceived = max(received, self.lastReceived or 0.0)
+        if self.archive:
+            self.archive.write(telegram, received if received is not None else time.time())
+        for n in self.prefixLengths:
+            handler = self.fs20handler.get(telegram[:n])
+            if handler is not None:
+                handler.handle(telegram, received)
                 return True
         self.log("no handler for telegram '%s'" % telegram)
         return False
@@ -114,6 +232,8 @@ class Fs20Receiver(threading.Thread):
     def closeHandlers(self):
         for handler in self.fs20handler.values():
             handler.stop()
+        if self.archive:
+            self.archive.stop()
 
     def register(self, telegram, handler):
         if telegram.startswith("K"):
@@ -122,63 +242,535 @@ class Fs20Receiver(threading.Thread):
             j = i + 0x80
             self.fs20handler["K%02X" % j] = handler
         self.fs20handler[telegram] = handler
+        self.prefixLengths = sorted(set(len(t) for t in self.fs20handler), reverse=True)
 
     def log(self, logStr):
         print(logStr)
         self.logger.log("Fs20Receiver: " + logStr)
 
 
-class FileWriter(object):
-    def __init__(self, targetDir, prefix):
+class FileWriter(threading.Thread):
+    # keeps the day's CSV file open and writes rows buffered; a background thread flushes them at the latest
+    # flushInterval seconds after they were written. A row with a timestamp outside the open file's day switches
+    # to that day's file. fsync: "never", "close" (when a file is closed: midnight, stop) or "flush" (every flush)
+    FSYNC = ("never", "close", "flush")
+
+    def __init__(self, targetDir, prefix, flushInterval=5.0, fsync="close", columns=None):
+        super(FileWriter, self).__init__()
+        self.daemon = True
         self.targetDir = targetDir
         self.prefix = prefix
+        self.flushInterval = flushInterval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        self.file = None
+        self.dirty = False
+        # the open file's day as [start, end) in seconds since the epoch
+        self.dayStart = 0
+        self.dayEnd = 0
+        self.second = None
+        self.timeString = ""
+        # the same rows in binary as well, see ColumnWriter
+        self.columnWriter = ColumnWriter(os.path.join(targetDir, prefix + ".col"), columns) if columns else None
+        self.start()
 
-    def write(self, data):
-        filename = os.path.join(self.targetDir, "%s-%s.csv" % (self.prefix, time.strftime("%Y%m%d")))
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
         dataKeys = list(data.keys())
         dataKeys.sort()
-        if os.path.exists(filename):
-            f = open(filename, "a")
+        self.lock.acquire()
+        try:
+            # strftime once per second
+            second = int(timestamp)
+            if second != self.second:
+                self.second = second
+                self.timeString = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            if not self.dayStart <= timestamp < self.dayEnd or self.file is None:
+                self.open(time.localtime(second), dataKeys)
+            self.file.write("%s;%s\n" % (self.timeString, ";".join("%0.2f" % data[k] for k in dataKeys)))
+            if self.columnWriter:
+                self.columnWriter.write(data, timestamp)
+            if not self.dirty:
+                self.dirty = True
+                self.wakeup.set()
+        finally:
+            self.lock.release()
+
+    def open(self, localTime, dataKeys):
+        self.close()
+        self.dayStart = time.mktime((localTime.tm_year, localTime.tm_mon, localTime.tm_mday, 0, 0, 0, 0, 0, -1))
+        self.dayEnd = time.mktime((localTime.tm_year, localTime.tm_mon, localTime.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        filename = os.path.join(self.targetDir, "%s-%s.csv" % (self.prefix, time.strftime("%Y%m%d", localTime)))
+        self.file = open(filename, "a")
+        if self.file.tell() == 0:
+            self.file.write("time;%s\n" % ";".join(k for k in dataKeys))
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync != "never":
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.dirty = False
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.dirty and self.file is not None:
+                self.file.flush()
+                if self.fsync == "flush":
+                    os.fsync(self.file.fileno())
+                if self.columnWriter:
+                    self.columnWriter.flush(self.fsync == "flush")
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while self.running:
+            # sleep until something is written, then give it flushInterval to collect more rows
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.running:
+                time.sleep(self.flushInterval)
+            self.flush()
+
+    def stop(self):
+        # writes everything out and closes the file
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.lock.acquire()
+        try:
+            self.close()
+            if self.columnWriter:
+                self.columnWriter.close(self.fsync != "never")
+        finally:
+            self.lock.release()
+
+
+class TelegramArchive(FileWriter):
+    # the raw telegrams in the format fs20-serv sends them with '!timestamps', "<telegram>;<received>", in gzip
+    # files per day and start (<prefix>-YYYYMMDD-HHMMSS-NN.gz, the time of the first telegram); fs20-replay.py
+    # feeds them back to Fs20Receiver.notifyHandlers. A file is never appended to after a restart: a flush ends
+    # a deflate block and a file cut by a crash is readable up to there, but not with another gzip member after it.
+    def __init__(self, targetDir, prefix="telegrams", flushInterval=5.0, fsync="close"):
+        super(TelegramArchive, self).__init__(targetDir, prefix, flushInterval, fsync)
+        self.raw = None
+
+    def write(self, telegram, received):
+        self.lock.acquire()
+        try:
+            if not self.dayStart <= received < self.dayEnd or self.file is None:
+                self.open(received)
+            self.file.write(("%s;%.6f\n" % (telegram, received)).encode())
+            if not self.dirty:
+                self.dirty = True
+                self.wakeup.set()
+        finally:
+            self.lock.release()
+
+    def open(self, received):
+        self.close()
+        self.dayStart, self.dayEnd = bucketRange(received, 86400)
+        start = time.strftime("%Y%m%d-%H%M%S", time.localtime(received))
+        n = 0
+        while True:
+            filename = os.path.join(self.targetDir, "%s-%s-%02d.gz" % (self.prefix, start, n))
+            try:
+                self.raw = open(filename, "xb")
+                break
+            except FileExistsError:
+                n += 1
+        self.file = gzip.GzipFile(fileobj=self.raw, mode="wb")
+
+    def close(self):
+        # the gzip trailer before the fsync, a closed archive is complete on disk
+        if self.file is not None:
+            self.file.close()
+            self.raw.flush()
+            if self.fsync != "never":
+                os.fsync(self.raw.fileno())
+            self.raw.close()
+            self.file = None
+            self.raw = None
+            self.dirty = False
+
+
+class ColumnWriter(object):
+    # one append-only file per room: a 256 byte header (magic and the column names as JSON), then fixed size
+    # little endian records of the time (float64, seconds since the epoch) and one float32 per column, NaN for
+    # a value the row does not have. Rows are expected in time order, ColumnReader relies on it.
+    MAGIC = b"FS20COL1"
+    HEADER_SIZE = 256
+
+    def __init__(self, filename, columns):
+        self.filename = filename
+        if os.path.exists(filename) and os.path.getsize(filename) >= self.HEADER_SIZE:
+            self.columns = readColumnHeader(filename)
         else:
-            f = open(filename, "w")
-            f.write("time;%s\n" % ";".join(k for k in dataKeys))
-        f.write("%s;" % time.strftime("%Y-%m-%d %H:%M:%S"))
-        f.write("%s\n" % ";".join("%0.2f" % data[k] for k in dataKeys))
-        f.close()
+            self.columns = sorted(columns)
+        self.record = struct.Struct("<d%df" % len(self.columns))
+        self.file = open(filename, "ab")
+        if self.file.tell() == 0:
+            header = self.MAGIC + json.dumps(self.columns).encode()
+            if len(header) > self.HEADER_SIZE:
+                raise ValueError("%s: too many columns for the header" % filename)
+            self.file.write(header.ljust(self.HEADER_SIZE, b" "))
+        elif (self.file.tell() - self.HEADER_SIZE) % self.record.size:
+            # a record cut short by a crash would shift every later one
+            self.file.truncate(self.file.tell() - (self.file.tell() - self.HEADER_SIZE) % self.record.size)
+
+    def write(self, data, timestamp):
+        self.file.write(self.record.pack(timestamp, *[data.get(k, float("nan")) for k in self.columns]))
+
+    def flush(self, sync=False):
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self, sync=False):
+        if not self.file.closed:
+            self.flush(sync)
+            self.file.close()
+
+
+def readColumnHeader(filename):
+    f = open(filename, "rb")
+    header = f.read(ColumnWriter.HEADER_SIZE)
+    f.close()
+    if not header.startswith(ColumnWriter.MAGIC):
+        raise ValueError("%s is not a column file" % filename)
+    return json.loads(header[len(ColumnWriter.MAGIC):].decode())
+
+
+class ColumnReader(object):
+    # a column file mapped into memory: range() returns NumPy arrays (views, nothing is parsed or copied) of the
+    # rows from start (inclusive) to end (exclusive)
+    def __init__(self, filename):
+        if numpy is None:
+            raise RuntimeError("reading column files needs numpy")
+        self.columns = readColumnHeader(filename)
+        self.dtype = numpy.dtype([("time", "<f8")] + [(str(k), "<f4") for k in self.columns])
+        rows = (os.path.getsize(filename) - ColumnWriter.HEADER_SIZE) // self.dtype.itemsize
+        if rows > 0:
+            self.rows = numpy.memmap(filename, dtype=self.dtype, mode="r", offset=ColumnWriter.HEADER_SIZE,
+                                     shape=(rows,))
+        else:
+            self.rows = numpy.zeros(0, dtype=self.dtype)
+
+    def range(self, start=None, end=None):
+        times = self.rows["time"]
+        first = 0 if start is None else numpy.searchsorted(times, start, "left")
+        last = len(times) if end is None else numpy.searchsorted(times, end, "left")
+        rows = self.rows[first:last]
+        return dict((k, rows[k]) for k in ["time"] + self.columns)
+
+
+def bucketRange(timestamp, size):
+    # the bucket of size seconds timestamp falls in as [start, end), aligned to local time; a day bucket goes from
+    # midnight to midnight and may have 23 or 25 hours
+    local = time.localtime(timestamp)
+    if size == 86400:
+        start = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+        end = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        return start, end
+    start = timestamp - (timestamp + local.tm_gmtoff) % size
+    return start, start + size
+
+
+class Rollup(object):
+    # running count, min, max, mean and last of every column per minute, hour and day. When a sample falls past
+    # a bucket, the bucket is appended as one row to rollup/<prefix>-<level>.csv (a directory of its own, so
+    # filereader does not take them for day files); a bucket without samples has no row. stop() writes the open
+    # buckets as well, a restart within a bucket then gives two rows for it.
+    LEVELS = (("1m", 60), ("1h", 3600), ("1d", 86400))
+    STATS = ("count", "min", "max", "mean", "last")
+
+    def __init__(self, targetDir, prefix, columns):
+        self.targetDir = os.path.join(targetDir, "rollup")
+        os.makedirs(self.targetDir, exist_ok=True)
+        self.prefix = prefix
+        self.columns = sorted(columns)
+        # per level: [start, end, {column: [count, min, max, sum, last]}]
+        self.buckets = [[0, 0, {}] for name, size in self.LEVELS]
+        self.lock = threading.Lock()
+
+    def write(self, data, timestamp):
+        self.lock.acquire()
+        try:
+            for (name, size), bucket in zip(self.LEVELS, self.buckets):
+                if not bucket[0] <= timestamp < bucket[1]:
+                    self.close(name, bucket)
+                    bucket[0], bucket[1] = bucketRange(timestamp, size)
+                stats = bucket[2]
+                for k in self.columns:
+                    if k not in data:
+                        continue
+                    v = data[k]
+                    s = stats.get(k)
+                    if s is None:
+                        stats[k] = [1, v, v, v, v]
+                    else:
+                        s[0] += 1
+                        if v < s[1]:
+                            s[1] = v
+                        if v > s[2]:
+                            s[2] = v
+                        s[3] += v
+                        s[4] = v
+        finally:
+            self.lock.release()
+
+    def close(self, name, bucket):
+        stats = bucket[2]
+        if not stats:
+            return
+        fields = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(bucket[0]))]
+        for k in self.columns:
+            s = stats.get(k)
+            if s is None:
+                fields += ["0", "", "", "", ""]
+            else:
+                fields += ["%d" % s[0], "%0.2f" % s[1], "%0.2f" % s[2], "%0.2f" % (s[3] / s[0]), "%0.2f" % s[4]]
+        filename = os.path.join(self.targetDir, "%s-%s.csv" % (self.prefix, name))
+        f = open(filename, "a")
+        try:
+            if f.tell() == 0:
+                f.write("time;%s\n" % ";".join("%s_%s" % (k, stat) for k in self.columns for stat in self.STATS))
+            f.write("%s\n" % ";".join(fields))
+        finally:
+            f.close()
+        bucket[2] = {}
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            for (name, size), bucket in zip(self.LEVELS, self.buckets):
+                self.close(name, bucket)
+                bucket[0] = bucket[1] = 0
+        finally:
+            self.lock.release()
+
+
+class RecentSamples(object):
+    # the last size samples of a room in a ring of arrays: the times as float64, each column as float32 with NaN
+    # for a value the sample does not have. Samples are expected in time order, range() relies on it.
+    def __init__(self, size, columns):
+        self.size = size
+        self.columns = sorted(columns)
+        self.times = array.array("d", bytes(8 * size))
+        self.values = dict((k, array.array("f", bytes(4 * size))) for k in self.columns)
+        # samples written so far, the next one goes to count % size
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, data, timestamp):
+        self.lock.acquire()
+        try:
+            i = self.count % self.size
+            self.times[i] = timestamp
+            for k in self.columns:
+                self.values[k][i] = data.get(k, float("nan"))
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def search(self, lo, hi, timestamp):
+        # the first sample from lo to hi (counted like count) with a time >= timestamp
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.size] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        # the times and values of the samples from start (inclusive) to end (exclusive)
+        self.lock.acquire()
+        try:
+            first = self.search(max(self.count - self.size, 0), self.count, start)
+            last = self.search(first, self.count, end)
+            rows = [i % self.size for i in range(first, last)]
+            return [self.times[i] for i in rows], dict((k, [self.values[k][i] for i in rows]) for k in self.columns)
+        finally:
+            self.lock.release()
+
+    def latest(self):
+        self.lock.acquire()
+        try:
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % self.size
+            return self.times[i], dict((k, self.values[k][i]) for k in self.columns)
+        finally:
+            self.lock.release()
+
+
+def jsonValue(value):
+    # float32 back to the two decimals the sensors have, NaN is not JSON
+    return None if value != value else round(value, 2)
+
+
+class RecentQueries(object):
+    # answers what data clients ask about the recent samples, one JSON line per request (times in seconds since
+    # the epoch):
+    #   room <name> from <t1> to <t2>   {"reply": "room", "room": <name>, "time": [...], <column>: [...], ...}
+    #   latest                          {"reply": "latest", "rooms": {<name>: {"time": t, <column>: v, ...}, ...}}
+    # and {"reply": "error", "error": <reason>} for anything else
+    def __init__(self, size, columns):
+        self.size = size
+        self.columns = columns
+        self.rooms = {}
+
+    def room(self, name):
+        if name not in self.rooms:
+            self.rooms[name] = RecentSamples(self.size, self.columns)
+        return self.rooms[name]
+
+    def answer(self, request):
+        try:
+            reply = self.query(request)
+        except ValueError as exc:
+            reply = {"reply": "error", "error": "%s" % exc}
+        return json.JSONEncoder().encode(reply)
+
+    def query(self, request):
+        if request == "latest":
+            rooms = {}
+            for name, samples in list(self.rooms.items()):
+                latest = samples.latest()
+                if latest is not None:
+                    rooms[name] = dict((k, jsonValue(v)) for k, v in latest[1].items())
+                    rooms[name]["time"] = latest[0]
+            return {"reply": "latest", "rooms": rooms}
+        if request.startswith("room "):
+            name, sep, times = request[5:].rpartition(" from ")
+            start, sep2, end = times.partition(" to ")
+            if not sep or not sep2:
+                raise ValueError("expected 'room <name> from <t1> to <t2>'")
+            if name not in self.rooms:
+                raise ValueError("unknown room '%s'" % name)
+            times, values = self.rooms[name].range(float(start), float(end))
+            reply = {"reply": "room", "room": name, "time": times}
+            for k, column in values.items():
+                reply[k] = [jsonValue(v) for v in column]
+            return reply
+        raise ValueError("unknown request '%s'" % request)
 
 
 class DataObject(object):
-    def __init__(self, name, dataServer, logger):
+    def __init__(self, name, dataServer, logger, fileWriter=None, rollup=None, recent=None):
         self.name = name
         self.logger = logger
-        self.fileWriter = FileWriter("/tmp/fs20", name)
+        self.fileWriter = fileWriter or FileWriter("/tmp/fs20", name)
+        self.rollup = rollup
+        self.recent = recent
         self.dataServer = dataServer
 
     def log(self, logStr):
         print(logStr)
         self.logger.log("%s: " % self.name + logStr)
 
-    def write(self, data):
-        self.fileWriter.write(data)
+    def write(self, data, received=None):
+        # received: when fs20-serv read the telegram from the CUL, now if it did not say
+        if received is None:
+            received = time.time()
+        self.fileWriter.write(data, received)
+        if self.rollup:
+            self.rollup.write(data, received)
+        if self.recent:
+            self.recent.write(data, received)
         data["room"] = self.name
-        data["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        data["time"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(received))
+        # "time" keeps its format for existing clients, this one has the microseconds
+        data["received"] = round(received, 6)
         self.dataServer.write(json.JSONEncoder().encode(data))
 
     def stop(self):
-        pass
+        self.fileWriter.stop()
+        if self.rollup:
+            self.rollup.stop()
+
+
+def telegramMatrix(telegrams, length):
+    # telegrams of one length as a (rows, length) array of their ASCII codes
+    if any(len(telegram) != length for telegram in telegrams):
+        raise ConvertException("cannot convert, telegrams must all have %d characters" % length)
+    data = "".join(telegrams).encode("ascii", "replace")
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, length)
+
+
+def digitValues(matrix, *columns):
+    # decimal digits of the given columns, -1 for anything else
+    table = numpy.full(256, -1, dtype=numpy.int64)
+    table[ord("0"):ord("9") + 1] = numpy.arange(10)
+    return [table[matrix[:, column]] for column in columns]
+
+
+def signs(matrix, column):
+    # -1.0 where bit 3 of the hex digit in that column is set, as in convert(); NaN if it is not a hex digit
+    table = numpy.full(256, numpy.nan)
+    for c in "0123456789ABCDEFabcdef":
+        table[ord(c)] = -1.0 if int(c, 16) & 8 else 1.0
+    return table[matrix[:, column]]
+
+
+def decimals(tens, ones, tenths):
+    # what float("%c%c.%c") gives for these digits: integer tenths divided by 10.0 round the same way;
+    # NaN where one of them is not a digit
+    return numpy.where((tens < 0) | (ones < 0) | (tenths < 0), numpy.nan, (tens * 100 + ones * 10 + tenths) / 10.0)
+
+
+def convertS300THBatch(telegrams):
+    # S300TH.convert() for many telegrams at once, no handler needed (backfill): arrays of temperature and
+    # humidity with the values convert() returns; NaN for the telegrams convert() cannot read
+    if numpy is None:
+        raise ConvertException("batch conversion needs numpy")
+    matrix = telegramMatrix(telegrams, 9)
+    t6, t3, t4, t7, t8, t5 = digitValues(matrix, 6, 3, 4, 7, 8, 5)
+    temperature = signs(matrix, 1) * decimals(t6, t3, t4)
+    humidity = decimals(t7, t8, t5)
+    invalid = numpy.isnan(temperature) | numpy.isnan(humidity)
+    temperature[invalid] = numpy.nan
+    humidity[invalid] = numpy.nan
+    return temperature, humidity
+
+
+def convertHMS100TBatch(telegrams):
+    # HMS100T.convert() for many telegrams at once, no handler needed (backfill): arrays of temperature, humidity
+    # and status with the values convert() returns; NaN (status -1) for the telegrams convert() cannot read
+    if numpy is None:
+        raise ConvertException("batch conversion needs numpy")
+    matrix = telegramMatrix(telegrams, 13)
+    t10, t7, t8, t11, t12, t9, t5, t6 = digitValues(matrix, 10, 7, 8, 11, 12, 9, 5, 6)
+    temperature = signs(matrix, 5) * decimals(t10, t7, t8)
+    humidity = decimals(t11, t12, t9)
+    status = numpy.where((t5 < 0) | (t6 < 0), -1, t5 * 10 + t6)
+    invalid = numpy.isnan(temperature) | numpy.isnan(humidity) | (status < 0)
+    temperature[invalid] = numpy.nan
+    humidity[invalid] = numpy.nan
+    status[invalid] = -1
+    return temperature, humidity, status
 
 
 class S300TH(DataObject):
-    def __init__(self, name, dataServer, logger):
-        super(S300TH, self).__init__(name, dataServer, logger)
+    def __init__(self, name, dataServer, logger, fileWriter=None, rollup=None, recent=None):
+        super(S300TH, self).__init__(name, dataServer, logger, fileWriter, rollup, recent)
 
-    def handle(self, telegram):
+    def handle(self, telegram, received=None):
         if (len(telegram) != 9):
             self.log("%s: wrong length: '%s'" % (self.name, telegram))
             return
         try:
             temp, hum = self.convert(telegram)
-            self.write({"temperature": temp, "humidity": hum})
+            self.write({"temperature": temp, "humidity": hum}, received)
             self.log("%s: %4.1fC, %4.1f%%" % (self.name, temp, hum))
         except ConvertException as exc:
             self.log("%s: cannot convert K-telegram '%s': %s" % (self.name, telegram, exc))
@@ -195,18 +787,18 @@ class S300TH(DataObject):
 
 
 class HMS100T(DataObject):
-    def __init__(self, name, dataServer, logger):
-        super(HMS100T, self).__init__(name, dataServer, logger)
+    def __init__(self, name, dataServer, logger, fileWriter=None, rollup=None, recent=None):
+        super(HMS100T, self).__init__(name, dataServer, logger, fileWriter, rollup, recent)
 
-    def handle(self, telegram):
+    def handle(self, telegram, received=None):
         try:
             temp, hum, status = self.convert(telegram)
             if (hum == 0):
                 self.log("%s: %4.1fC, 0x%02X" % (self.name, temp, status))
-                self.write({"temperature": temp})
+                self.write({"temperature": temp}, received)
             else:
                 self.log("%s: %4.1fC, %4.1f%%, 0x%02X" % (self.name, temp, hum, status))
-                self.write({"temperature": temp, "humidity": hum})
+                self.write({"temperature": temp, "humidity": hum}, received)
         except ConvertException as exc:
             self.log("%s: cannot convert H-telegram '%s': %s" % (self.name, telegram, exc))
 
@@ -231,40 +823,184 @@ class ConvertException(Exception):
         return repr(self.value)
 
 
+class DataConnection(object):
+    # one data client: the lines not sent yet (shared with the other connections), how far the first one got,
+    # and what it sent after its last complete request line
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = b""
+        self.lines = collections.deque()
+        self.offset = 0
+        self.queued = 0
+
+
 class TcpServer(threading.Thread):
-    def __init__(self, tcpPort):
+    # sends the JSON lines to all clients from one selector thread: write() only encodes the line once and queues
+    # it, the same bytes object for every client. A client with more than highWater bytes queued, one that closed
+    # its end or one the kernel reports as dead (TCP keepalive) is disconnected. The lines clients send are
+    # requests for queries (see RecentQueries), answered to that client only; without queries they are ignored.
+    def __init__(self, tcpPort, logger=None, highWater=1048576, queries=None):
         super().__init__()
-        self.connections = []
+        self.daemon = True
         self.tcpPort = tcpPort
+        self.logger = logger
+        self.highWater = highWater
+        self.queries = queries
+        self.connections = {}
+        self.pending = collections.deque()
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReceiver, self.wakeupSender = socket.socketpair()
+        self.wakeupReceiver.setblocking(False)
+        self.wakeupSender.setblocking(False)
+        self.wakeupSent = False
+        self.socket = None
+
+    def log(self, logStr):
+        print(logStr)
+        if self.logger:
+            self.logger.log("TcpServer: " + logStr)
 
     def run(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(("", self.tcpPort))
         s.listen()
+        s.setblocking(False)
+        self.socket = s
+        self.selector.register(s, selectors.EVENT_READ)
+        self.selector.register(self.wakeupReceiver, selectors.EVENT_READ)
         while True:
-            # accept connections from outside
-            (clientsocket, address) = s.accept()
-            self.connections.append(clientsocket)
-            print("new connection: %s" % clientsocket)
+            for key, events in self.selector.select():
+                if key.fileobj is s:
+                    self.accept()
+                elif key.fileobj is self.wakeupReceiver:
+                    self.queuePending()
+                else:
+                    # an earlier key of the same batch may have disconnected it (queuePending: highWater)
+                    connection = key.data
+                    if connection.sock not in self.connections:
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self.read(connection)
+                    if events & selectors.EVENT_WRITE and connection.sock in self.connections:
+                        self.send(connection)
+
+    def accept(self):
+        try:
+            clientsocket, address = self.socket.accept()
+        except OSError:
+            return
+        clientsocket.setblocking(False)
+        clientsocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Linux: give up on a peer that has not answered for about two minutes
+        for option, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 6)):
+            if hasattr(socket, option):
+                clientsocket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        connection = DataConnection(clientsocket, address)
+        self.connections[clientsocket] = connection
+        self.selector.register(clientsocket, selectors.EVENT_READ, connection)
+        self.log("new connection: %s:%d" % address)
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self.disconnect(connection, "%s" % exc)
+            return
+        if not data:
+            self.disconnect(connection, "closed by the client")
+            return
+        if self.queries is None:
+            return
+        lines = (connection.buffer + data).split(b"\n")
+        connection.buffer = lines.pop()
+        if len(connection.buffer) > 4096:
+            self.disconnect(connection, "request line too long")
+            return
+        for line in lines:
+            request = line.decode("utf-8", "replace").strip()
+            if request and connection.sock in self.connections:
+                reply = ("%s\n" % self.queries.answer(request)).encode("utf-8")
+                self.queue(connection, [reply], len(reply))
 
     def write(self, data):
-        socketsToRemove = []
-        for clientsocket in self.connections:
+        # called from the Fs20Receiver thread, never blocks
+        self.pending.append(("%s\n" % data).encode("utf-8"))
+        if not self.wakeupSent:
+            self.wakeupSent = True
             try:
-                clientsocket.send(("%s\n" % data).encode("utf-8"))
-            except Exception as exc:
-                print("Exception %s when writing to %s" % (exc, clientsocket))
-                socketsToRemove.append(clientsocket)
-        for socketToRemove in socketsToRemove:
-            self.connections.remove(socketToRemove)
-            print("removing connection %s" % socketToRemove)
+                self.wakeupSender.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def queuePending(self):
+        try:
+            while self.wakeupReceiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        # reset before taking the lines, a line queued from now on sends a new wakeup
+        self.wakeupSent = False
+        lines = []
+        while self.pending:
+            lines.append(self.pending.popleft())
+        size = sum(len(line) for line in lines)
+        for connection in list(self.connections.values()):
+            self.queue(connection, lines, size)
+
+    def queue(self, connection, lines, size):
+        if connection.queued + size > self.highWater:
+            self.disconnect(connection, "more than %d bytes queued" % self.highWater)
+            return
+        if not connection.lines:
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+        connection.lines.extend(lines)
+        connection.queued += size
+        self.send(connection)
+
+    def send(self, connection):
+        while connection.lines:
+            line = connection.lines[0]
+            try:
+                sent = connection.sock.send(memoryview(line)[connection.offset:])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.disconnect(connection, "%s" % exc)
+                return
+            connection.queued -= sent
+            connection.offset += sent
+            if connection.offset < len(line):
+                return
+            connection.lines.popleft()
+            connection.offset = 0
+        self.selector.modify(connection.sock, selectors.EVENT_READ, connection)
+
+    def disconnect(self, connection, reason):
+        if connection.sock not in self.connections:
+            return
+        self.log("removing connection %s:%d: %s" % (connection.address + (reason,)))
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        del self.connections[connection.sock]
 
 
 class Config(object):
     def __init__(self, configFilename):
         self.configFilename = configFilename
         self.sources = None
+        self.logPrefix = "/var/log/fs20/fs20-osv-history"
+        self.dataDir = "/tmp/fs20"
+        self.flushInterval = 5.0
+        self.fsync = "close"
+        self.columnStore = False
+        self.highWater = 1048576
+        self.rollups = True
+        self.recentSize = 10000
+        self.archive = False
 
     def read(self):
         f = open(self.configFilename, "r")
@@ -276,44 +1012,103 @@ class Config(object):
             v = v.strip()
             if k == "sources":
                 self.sources = json.JSONDecoder().decode(v)
+            elif k == "logPrefix":
+                self.logPrefix = v
+            elif k == "dataDir":
+                self.dataDir = v
+            elif k == "flushInterval":
+                self.flushInterval = float(v)
+            elif k == "fsync":
+                self.fsync = v
+            elif k == "highWater":
+                self.highWater = int(v)
+            elif k == "columnStore":
+                self.columnStore = v.lower() in ("1", "yes", "true", "on")
+            elif k == "recentSize":
+                self.recentSize = int(v)
+            elif k == "archive":
+                self.archive = v.lower() in ("1", "yes", "true", "on")
+            elif k == "rollups":
+                self.rollups = v.lower() in ("1", "yes", "true", "on")
 
     def validate(self):
         if not self.sources:
             sys.stderr.write("config file must contain 'sources'\n")
+        if self.fsync not in FileWriter.FSYNC:
+            sys.stderr.write("config 'fsync' must be one of %s\n" % ", ".join(FileWriter.FSYNC))
+
+
+def registerHandlers(fs20Receiver, config, dataServer, logger, targetDir="/tmp/fs20", queries=None):
+    # an S300TH or HMS100T per room of the config's sources, writing to targetDir
+    for roomName, telegramPrefix in config.sources.items():
+        fileWriter = FileWriter(targetDir, roomName, config.flushInterval, config.fsync,
+                                ["temperature", "humidity"] if config.columnStore else None)
+        rollup = Rollup(targetDir, roomName, ["temperature", "humidity"]) if config.rollups else None
+        recent = queries.room(roomName) if queries else None
+        if telegramPrefix.startswith("K"):
+            fs20Receiver.register(telegramPrefix, S300TH(roomName, dataServer, logger, fileWriter, rollup, recent))
+        elif telegramPrefix.startswith("H"):
+            fs20Receiver.register(telegramPrefix, HMS100T(roomName, dataServer, logger, fileWriter, rollup, recent))
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("usage: %s <fs20-server> <data-server-port> <config>" % sys.argv[0])
         print("ex:    %s localhost:7890 9990 config.fs20" % sys.argv[0])
+        print("")
+        print("<config> must contain sources, a JSON encoded dict of <room>:<telegram prefix>, and may contain:")
+        print("  logPrefix: <path>         (default /var/log/fs20/fs20-osv-history)")
+        print("  dataDir: <path>           (where the CSV and other data files go, default /tmp/fs20)")
+        print("  flushInterval: <seconds>  (CSV rows are written out at the latest after this time, default 5)")
+        print("  fsync: never|close|flush  (when CSV files are synced to disk: never, when a file is closed at")
+        print("                            midnight or on exit, or on every flush; default close)")
+        print("  highWater: <bytes>        (a data client with more than this queued is disconnected, default 1048576)")
+        print("  columnStore: on|off       (also write every room's rows to <room>.col, float64 time and float32")
+        print("                            values, for reading with ColumnReader; default off)")
+        print("  rollups: on|off           (count, min, max, mean and last per minute, hour and day in")
+        print("                            rollup/<room>-1m|1h|1d.csv; default on)")
+        print("  recentSize: <samples>     (samples per room kept in memory for the requests 'room <name> from")
+        print("                            <t1> to <t2>' and 'latest' on the data server port; default 10000,")
+        print("                            0: no requests)")
+        print("  archive: on|off           (also write every raw telegram to telegrams-YYYYMMDD-HHMMSS-NN.gz, for")
+        print("                            fs20-replay.py; default off)")
+        print("")
+        print("the data server port sends one JSON object per row: the room's values, 'room', 'time' (local time,")
+        print("'YYYY-MM-DD HH:MM:SS') and 'received' (when fs20-serv read the telegram, seconds since the epoch)")
         sys.exit(-1)
 
-for arg in sys.argv:
-    print(arg)
+    for arg in sys.argv:
+        print(arg)
+
+    fs20Server = sys.argv[1]
+    dataServerPort = int(sys.argv[2])
+    configFileName = sys.argv[3]
+
+    startTime = time.ctime()
 
-fs20Server = sys.argv[1]
-dataServerPort = int(sys.argv[2])
-configFileName = sys.argv[3]
+    config = Config(configFileName)
+    config.read()
+    config.validate()
 
-startTime = time.ctime()
+    logger = Logger(config.logPrefix)
 
-logger = Logger("/var/log/fs20/fs20-osv-history")
+    queries = RecentQueries(config.recentSize, ["temperature", "humidity"]) if config.recentSize > 0 else None
+    dataServer = TcpServer(dataServerPort, logger, config.highWater, queries)
+    dataServer.start()
 
-dataServer = TcpServer(dataServerPort)
-dataServer.start()
+    if not os.path.exists(config.dataDir):
+        os.makedirs(config.dataDir)
 
-config = Config(configFileName)
-config.read()
-config.validate()
+    fs20Receiver = Fs20Receiver(fs20Server, logger)
+    if config.archive:
+        fs20Receiver.archive = TelegramArchive(config.dataDir, "telegrams", config.flushInterval, config.fsync)
 
-if not os.path.exists("/tmp/fs20"):
-    os.makedirs("/tmp/fs20")
+    registerHandlers(fs20Receiver, config, dataServer, logger, config.dataDir, queries)
 
-fs20Receiver = Fs20Receiver(fs20Server, logger)
+    def terminate(signum, frame):
+        # systemd stop, kill: shut down as on Ctrl-C, the handlers write out and close their files. Raised rather
+        # than handled here, the main thread may be inside a FileWriter holding its lock.
+        raise KeyboardInterrupt()
 
-for roomName, telegramPrefix in config.sources.items():
-    if telegramPrefix.startswith("K"):
-        fs20Receiver.register(telegramPrefix, S300TH(roomName, dataServer, logger))
-    elif telegramPrefix.startswith("H"):
-        fs20Receiver.register(telegramPrefix, HMS100T(roomName, dataServer, logger))
-fs20Receiver.run()
+    signal.signal(signal.SIGTERM, terminate)
+    fs20Receiver.run()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import gzip
+import os
+import sys
+import time
+import zlib
+
+from scriptloader import loadScript
+
+
+class NullDataServer(object):
+    # stands in for the data server when nobody is to get the JSON lines
+    def write(self, data):
+        pass
+
+
+def archiveLines(fileName):
+    # (received, line) per telegram of a TelegramArchive file; a file cut by a crash ends at its last flush
+    f = gzip.open(fileName, "rt")
+    count = 0
+    try:
+        for line in f:
+            telegram, separator, stamp = line.rstrip("\n").partition(";")
+            if separator:
+                count += 1
+                yield float(stamp), line.rstrip("\n")
+    except EOFError:
+        sys.stderr.write("%s: cut short after %d telegrams, the ones after the last flush are lost\n" % (
+            fileName, count))
+    except (zlib.error, gzip.BadGzipFile) as exc:
+        sys.stderr.write("%s: unreadable after %d telegrams (%s), the rest of the file is lost\n" % (
+            fileName, count, exc))
+    finally:
+        f.close()
+
+
+def replay(fs20Receiver, fileNames, speed=1.0):
+    # every archived telegram to fs20Receiver.notifyHandlers, speed times as fast as it was received, as fast as
+    # possible for speed 0; returns the number of telegrams, the seconds it took and the largest delay behind
+    # schedule
+    count = 0
+    lag = 0.0
+    start = time.monotonic()
+    first = None
+    for fileName in fileNames:
+        for received, line in archiveLines(fileName):
+            if speed > 0:
+                if first is None:
+                    first = received
+                due = start + (received - first) / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            fs20Receiver.notifyHandlers(line)
+            count += 1
+    return count, time.monotonic() - start, lag
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print("usage: %s <config> <target-dir> <speed> <archive> [<archive> ...]" % sys.argv[0])
+        print("ex:    %s config.fs20 /tmp/fs20-backfill max /tmp/fs20/telegrams-20261017-*.gz" % sys.argv[0])
+        print("")
+        print("feeds the telegrams fs20-osv-history archived with 'archive: on' to the handlers of the rooms in")
+        print("<config>, writing CSV, column and rollup files to <target-dir> like fs20-osv-history does")
+        print("  <speed>: 1 for real time, <n> for n times as fast, max for as fast as possible")
+        sys.exit(-1)
+    history = loadScript("fs20-osv-history.py")
+    config = history.Config(sys.argv[1])
+    config.read()
+    config.validate()
+    targetDir = sys.argv[2]
+    speed = 0.0 if sys.argv[3] == "max" else float(sys.argv[3])
+    if not os.path.exists(targetDir):
+        os.makedirs(targetDir)
+    logger = history.Logger(os.path.join(targetDir, "fs20-replay"))
+    fs20Receiver = history.Fs20Receiver("replay:0", logger)
+    history.registerHandlers(fs20Receiver, config, NullDataServer(), logger, targetDir)
+    try:
+        count, elapsed, lag = replay(fs20Receiver, sorted(sys.argv[4:]), speed)
+    finally:
+        fs20Receiver.closeHandlers()
+        logger.stop()
+    print("%d telegrams in %.1fs, %.0f telegrams/s, at most %.3fs behind schedule" % (
+        count, elapsed, count / elapsed if elapsed > 0 else 0, lag))
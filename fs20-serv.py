@@ -3,7 +3,16 @@
 from threading import Thread
 from threading import Event
 from threading import Lock
+from threading import Condition
+import collections
+import asyncio
+import atexit
+import bisect
+import http.server
+import json
 import queue
+import re
+import signal
 import socket
 import sys
 import time
@@ -11,65 +20,859 @@ import serial
 import os
 
 
-class Logger(object):
-    def __init__(self, logPrefix):
+class Config(object):
+    def __init__(self):
+        self.server = "threaded"
+        self.sticks = "failover"
+        self.mergeWindow = 0.5
+        self.dedupWindow = 0.5
+        self.queueSize = 1000
+        self.overflowPolicy = "drop-oldest"
+        self.ackTimeoutMin = 0.1
+        self.ackTimeoutMax = 1.0
+        self.creditPollInterval = 60.0
+        self.creditReserve = 0.1
+        self.bulkReserve = 2.0
+        self.starvationTimeout = 30.0
+        self.metricsPort = 0
+        self.replaySize = 1000
+        self.replayMaxAge = 3600.0
+        self.replayPolicy = "drop-oldest"
+        self.logPrefix = "/var/log/fs20/fs20"
+
+    def read(self, configFilename):
+        f = open(configFilename, "r")
+        lines = f.readlines()
+        f.close()
+        for line in lines:
+            if not line.strip() or line.startswith("#"):
+                continue
+            k, v = line.split(":", 1)
+            k = k.strip()
+            v = v.strip()
+            if not hasattr(self, k):
+                sys.stderr.write("unknown config key '%s'\n" % k)
+            elif isinstance(getattr(self, k), bool):
+                setattr(self, k, v.lower() in ("1", "yes", "true", "on"))
+            else:
+                setattr(self, k, type(getattr(self, k))(v))
+
+    def validate(self):
+        if self.server not in ("threaded", "asyncio"):
+            sys.stderr.write("config 'server' must be 'threaded' or 'asyncio'\n")
+            return False
+        if self.sticks not in ("failover", "active"):
+            sys.stderr.write("config 'sticks' must be 'failover' or 'active'\n")
+            return False
+        if self.overflowPolicy not in OutboundQueue.POLICIES:
+            sys.stderr.write("config 'overflowPolicy' must be one of %s\n" % ", ".join(OutboundQueue.POLICIES))
+            return False
+        if self.replayPolicy not in ReplayBuffer.POLICIES:
+            sys.stderr.write("config 'replayPolicy' must be one of %s\n" % ", ".join(ReplayBuffer.POLICIES))
+            return False
+        return True
+
+
+class Logger(Thread):
+    # log() only appends the line to a deque; a background thread formats, writes and flushes the lines in batches,
+    # every flushInterval seconds or as soon as flushSize lines are waiting. At most maxRecords lines wait, the
+    # oldest are dropped (and counted) when the thread cannot keep up or cannot write
+    def __init__(self, logPrefix, flushInterval=1.0, flushSize=500, maxRecords=100000):
+        Thread.__init__(self)
+        self.daemon = True
         self.logPrefix = logPrefix
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.records = collections.deque(maxlen=maxRecords)
+        self.dropped = 0
+        # the error the last batch failed with, reported once until a batch is written again
+        self.failure = None
+        self.wakeup = Event()
+        self.running = True
         self.date = time.strftime("%Y-%m-%d")
+        self.second = None
+        self.timestamp = ""
         self.logFile = open(self.logPrefix + "." + self.date, "a")
+        self.start()
+        # the thread is a daemon: write what is still waiting when the process exits without stop()
+        atexit.register(self.stop)
 
     def log(self, str):
-        date = time.strftime("%Y-%m-%d")
-        if date != self.date:
-            self.logFile.write("%s starting new logfile" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            self.logFile.close()
-            self.date = date
-            self.logFile = open(self.logPrefix + "." + self.date, "w")
-            self.logFile.write("%s starting new logfile" % time.strftime('%Y-%m-%d %H:%M:%S'))
-            oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(time.time() - 2 * 86400))
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), str))
+        if len(self.records) >= self.flushSize:
+            self.wakeup.set()
+
+    def run(self):
+        while self.running or self.records:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            if not self.records:
+                continue
+            # take the batch off the deque first: log() evicts records[0] once the deque is full
+            batch = [self.records.popleft() for i in range(len(self.records))]
+            written = 0
             try:
-                os.remove(oldLogFileName)
+                if self.logFile.closed:
+                    # a rotation or an earlier batch failed before a new file was open
+                    self.logFile = open(self.logPrefix + "." + self.date, "a")
+                for record in batch:
+                    self.write(*record)
+                    written += 1
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.logFile.write("%s %d log lines dropped\n" % (self.timestamp, dropped))
+                self.logFile.flush()
+                self.failure = None
             except Exception as exc:
-                self.logFile.write("%s cannot delete old log file %s: %s" % (
-                    time.strftime('%Y-%m-%d %H:%M:%S'), oldLogFileName, exc))
-        self.logFile.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'), str))
-        self.logFile.flush()
+                # disk full, permissions: keep the lines and try again with the next batch
+                if self.failure is None:
+                    sys.stderr.write("Logger: cannot write to %s: %s\n" % (self.logPrefix, exc))
+                self.failure = exc
+                # the unwritten lines go back in front of the ones logged meanwhile
+                for record in reversed(batch[written:]):
+                    if len(self.records) == self.records.maxlen:
+                        self.dropped += 1
+                    self.records.appendleft(record)
+                if not self.running:
+                    break
+        try:
+            self.logFile.close()
+        except Exception:
+            pass
 
-    def stop(self):
+    def write(self, timestamp, str):
+        # strftime once per second instead of twice per line
+        second = int(timestamp)
+        if second != self.second:
+            self.second = second
+            self.timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            if self.timestamp[:10] != self.date:
+                self.rotate(self.timestamp[:10], second)
+        self.logFile.write("%s %s\n" % (self.timestamp, str))
+
+    def rotate(self, date, second):
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
         self.logFile.close()
+        self.date = date
+        self.logFile = open(self.logPrefix + "." + self.date, "w")
+        self.logFile.write("%s starting new logfile\n" % self.timestamp)
+        oldLogFileName = self.logPrefix + "." + time.strftime("%Y-%m-%d", time.localtime(second - 2 * 86400))
+        try:
+            os.remove(oldLogFileName)
+        except Exception as exc:
+            self.logFile.write("%s cannot delete old log file %s: %s\n" % (self.timestamp, oldLogFileName, exc))
+
+    def stop(self):
+        # writes and flushes everything logged so far; called again at exit, which does nothing then
+        if not self.is_alive():
+            return
+        self.running = False
+        self.wakeup.set()
+        self.join(5)
 
 
-class Fs20(Thread):
-    def __init__(self, devices, logger):
+class CulReader(object):
+    def __init__(self, cul):
+        self.cul = cul
+        self.buffer = b''
+        # wall clock and monotonic time the last chunk arrived, shared by all telegrams it completes
+        self.stamp = (0.0, 0.0)
+
+    def read(self):
+        # take everything the CUL has delivered in one call, block (up to the read timeout) only if nothing is there
+        data = self.cul.read(self.cul.in_waiting or 1)
+        if not data:
+            return []
+        self.stamp = (time.time(), time.monotonic())
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return [line.rstrip(b'\r').decode() for line in lines if line.rstrip(b'\r')]
+
+
+class OutboundQueue(object):
+    # bounded per-client send queue; put() never blocks, a full queue is handled by the overflow policy
+    POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+
+    def __init__(self, maxSize, policy):
+        self.items = collections.deque()
+        self.maxSize = maxSize
+        self.policy = policy
+        self.condition = Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        # returns True if the writer has to be woken up (first item queued or queue closed by overflow)
+        self.condition.acquire()
+        try:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxSize:
+                self.dropped += 1
+                if self.policy == "drop-newest":
+                    return False
+                if self.policy == "disconnect":
+                    self.closed = True
+                    self.condition.notify()
+                    return True
+                self.items.popleft()
+            self.items.append(item)
+            self.condition.notify()
+            return len(self.items) == 1
+        finally:
+            self.condition.release()
+
+    def getAll(self, timeout=None):
+        # everything queued so far, waits for at least one item unless the queue is closed or timeout is 0
+        self.condition.acquire()
+        try:
+            if not self.items and not self.closed and timeout != 0:
+                self.condition.wait(timeout)
+            items = list(self.items)
+            self.items.clear()
+            return items
+        finally:
+            self.condition.release()
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class CoalescingQueue(object):
+    # one FIFO per priority class; a command that sets an actuator's state replaces the commands still pending for it
+    PRIORITIES = ("interactive", "normal", "bulk")
+
+    def __init__(self, starvationTimeout):
+        self.condition = Condition()
+        self.levels = [collections.deque() for priority in self.PRIORITIES]
+        self.pending = {}
+        self.starvationTimeout = starvationTimeout
+        self.coalesced = 0
+        self.dropped = 0
+
+    def key(self, telegram):
+        # "F" + housecode + address, only for commands that do not depend on the actuator's current state:
+        # off, dim levels and on (0x00 - 0x11) without extension byte; toggle, dim up/down, timed commands, timer
+        # programming etc. are never replaced and, like toggles, are sent after everything pending before them
+        telegram = telegram.strip().upper()
+        if not telegram.startswith("F") or len(telegram) != 9:
+            return None
+        try:
+            command = int(telegram[7:9], 16)
+        except ValueError:
+            return None
+        return telegram[:7] if command & 0xE0 == 0 and command <= 0x11 else None
+
+    def put(self, telegram, priority="normal", enqueued=None, front=False):
+        # returns the pending telegrams that will not be sent any more
+        level = self.PRIORITIES.index(priority)
+        self.condition.acquire()
+        try:
+            key = self.key(telegram)
+            entries = self.pending.get(key) if key else None
+            dropped = []
+            if entries and front:
+                # put back after something newer for the same actuator was queued: the newer one wins
+                if entries[0][0] != telegram:
+                    self.dropped += 1
+                return dropped
+            if entries:
+                for entry in entries:
+                    if entry[0] != telegram:
+                        dropped.append(entry[0])
+                self.dropped += len(dropped)
+                if entries[0][2] <= level:
+                    # keep the place in the queue of the oldest pending command for this actuator
+                    self.coalesced += 1
+                    for entry in entries[1:]:
+                        entry[0] = None
+                    entries[0][0] = telegram
+                    del entries[1:]
+                    return dropped
+                # the pending commands are less urgent than the new one, which is queued in its own class
+                for entry in entries:
+                    entry[0] = None
+                del self.pending[key]
+            # the last field: put back to let something more urgent go first, see __next
+            entry = [telegram, key, level, enqueued or time.monotonic(), front]
+            if front:
+                self.levels[level].appendleft(entry)
+                if key:
+                    self.pending.setdefault(key, []).insert(0, entry)
+            else:
+                self.levels[level].append(entry)
+                if key:
+                    self.pending.setdefault(key, []).append(entry)
+                elif telegram.startswith("F") and len(telegram) >= 7:
+                    # a toggle, dim step or timed command has to be sent after everything pending for the actuator
+                    self.pending.pop(telegram[:7].upper(), None)
+            self.condition.notify_all()
+            return dropped
+        finally:
+            self.condition.release()
+
+    def __head(self, level):
+        entries = self.levels[level]
+        while entries and entries[0][0] is None:
+            entries.popleft()
+        return entries[0] if entries else None
+
+    def __next(self):
+        # the most urgent class first, unless a less urgent head has been waiting longer than starvationTimeout.
+        # A starving head that was put back for something more urgent lets that go first, once, instead of being
+        # picked again right away.
+        now = time.monotonic()
+        first = None
+        starving = None
+        yielded = []
+        for level in range(len(self.levels)):
+            entry = self.__head(level)
+            if entry is None:
+                continue
+            if first is None:
+                first = level
+            elif entry[4]:
+                yielded.append(entry)
+            elif now - entry[3] > self.starvationTimeout and (starving is None or entry[3] < starving[1]):
+                starving = (level, entry[3])
+        for entry in yielded:
+            entry[4] = False
+        return starving[0] if starving else first
+
+    def get(self, block=True, timeout=None):
+        # returns telegram, priority and the time it was queued
+        self.condition.acquire()
+        try:
+            while True:
+                level = self.__next()
+                if level is not None:
+                    break
+                if not block:
+                    raise queue.Empty
+                if not self.condition.wait(timeout):
+                    raise queue.Empty
+            entry = self.levels[level].popleft()
+            entries = self.pending.get(entry[1])
+            if entries and entries[0] is entry:
+                del entries[0]
+                if not entries:
+                    del self.pending[entry[1]]
+            return entry[0], self.PRIORITIES[level], entry[3]
+        finally:
+            self.condition.release()
+
+    def waitForMoreUrgent(self, priority, timeout):
+        # waits up to timeout, returns True as soon as something more urgent than priority is queued
+        level = self.PRIORITIES.index(priority)
+        deadline = time.monotonic() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                for more in range(level):
+                    if self.__head(more) is not None:
+                        return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+    def telegrams(self, priority=None):
+        self.condition.acquire()
+        try:
+            return [entry[0] for level in range(len(self.levels)) for entry in self.levels[level]
+                    if entry[0] is not None and priority in (None, self.PRIORITIES[level])]
+        finally:
+            self.condition.release()
+
+    def qsize(self, priority=None):
+        return len(self.telegrams(priority))
+
+
+class DutyCycle(object):
+    # the CUL may use 1% of the airtime: credit refills by 10ms per second up to 9s (culfw's MAX_CREDIT of 900)
+    CAPACITY = 9.0
+    RATE = 0.01
+    STATUS = re.compile(r"^[0-9A-F]{2}\s+(\d+)$")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.credit = self.CAPACITY
+        self.updated = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.credit = min(self.credit + (now - self.updated) * self.RATE, self.CAPACITY)
+        self.updated = now
+
+    def available(self):
+        self.lock.acquire()
+        try:
+            self.__refill()
+            return self.credit
+        finally:
+            self.lock.release()
+
+    def waitTime(self, cost):
+        # seconds until the credit covers cost
+        return max(cost - self.available(), 0.0) / self.RATE
+
+    def consume(self, cost):
+        self.lock.acquire()
+        try:
+            self.__refill()
+            self.credit = max(self.credit - cost, 0.0)
+        finally:
+            self.lock.release()
+
+    def update(self, credit):
+        self.lock.acquire()
+        try:
+            self.credit = min(credit, self.CAPACITY)
+            self.updated = time.monotonic()
+        finally:
+            self.lock.release()
+
+    def parseStatus(self, reply):
+        # reply of the CUL's 'X' command, e.g. "21  900": report mode and credit in 10ms units
+        match = self.STATUS.match(reply)
+        if match:
+            self.update(int(match.group(1)) / 100.0)
+        return match is not None
+
+
+def estimateAirtime(telegram):
+    # FS20 frame: 12 sync bits, a start bit, 8 data bits plus parity per byte (checksum included) and an end bit,
+    # '0' takes 800us and '1' 1200us; the CUL sends it 3 times with 10ms pauses. Other commands cost nothing.
+    telegram = telegram.strip()
+    if not telegram.startswith("F") or len(telegram) < 9:
+        return 0.0
+    try:
+        data = bytes.fromhex(telegram[1:])
+    except ValueError:
+        return 0.0
+    data += bytes([(6 + sum(data)) & 0xff])
+    bits = 12 + 1 + 9 * len(data) + 1
+    ones = 1
+    for byte in data:
+        n = bin(byte).count("1")
+        ones += n + (n & 1)
+    frame = (bits - ones) * 0.0008 + ones * 0.0012
+    return 3 * frame + 2 * 0.01
+
+
+class Deduplicator(object):
+    # transmitters repeat every frame; a telegram seen again within dedupWindow is a duplicate, and so is one
+    # another stick (or our own transmission) already delivered within mergeWindow
+    def __init__(self, dedupWindow, mergeWindow):
+        self.dedupWindow = dedupWindow
+        self.mergeWindow = mergeWindow
+        self.lock = Lock()
+        self.recent = collections.OrderedDict()
+        self.suppressed = 0
+
+    def normalise(self, telegram):
+        return telegram.strip().upper()
+
+    def isDuplicate(self, telegram, stick=None):
+        key = self.normalise(telegram)
+        now = time.monotonic()
+        horizon = max(self.dedupWindow, self.mergeWindow)
+        self.lock.acquire()
+        try:
+            while self.recent:
+                oldest = next(iter(self.recent.values()))
+                if now - oldest[0] <= horizon:
+                    break
+                self.recent.popitem(last=False)
+            last = self.recent.get(key)
+            if last and (now - last[0] <= self.dedupWindow or (last[1] is not stick and now - last[0] <= self.mergeWindow)):
+                self.suppressed += 1
+                return True
+            # the window starts with the first frame, a telegram repeated for a long time still gets through
+            self.recent[key] = (now, stick)
+            self.recent.move_to_end(key)
+            return False
+        finally:
+            self.lock.release()
+
+    def seen(self, telegram):
+        # our own transmission, its echo is a duplicate
+        self.isDuplicate(telegram)
+
+
+def addressKey(telegram):
+    # the device a telegram is from or for: FS20 housecode and address, S300TH address (the sign bit of negative
+    # temperatures masked out), HMS address; None for everything else
+    try:
+        if telegram.startswith("F") and len(telegram) >= 9:
+            return telegram[:7].upper()
+        if telegram.startswith("K") and len(telegram) >= 9:
+            return "K%02X" % (int(telegram[1:3], 16) & 0x7F)
+        if telegram.startswith("H") and len(telegram) >= 13:
+            return telegram[:5].upper()
+    except ValueError:
+        pass
+    return None
+
+
+class ReplayBuffer(object):
+    # the last telegrams with their receive times, for clients that (re)connect; bounded by maxSize entries and
+    # maxAge seconds (0: no limit). When full, "drop-oldest" evicts the oldest telegram, "keep-per-address" the oldest
+    # one whose device has a newer telegram in the buffer, so the last telegram of every device stays available.
+    POLICIES = ("drop-oldest", "keep-per-address")
+
+    def __init__(self, maxSize, maxAge, policy):
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.policy = policy
+        self.lock = Lock()
+        # entries: (wall clock, monotonic, telegram, address key)
+        self.entries = collections.deque()
+        self.perAddress = collections.Counter()
+
+    def append(self, telegram, stamp):
+        if self.maxSize <= 0:
+            return
+        entry = (stamp[0], stamp[1], telegram, addressKey(telegram))
+        self.lock.acquire()
+        try:
+            self.entries.append(entry)
+            self.perAddress[entry[3]] += 1
+            self.expire()
+            if len(self.entries) > self.maxSize:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        if self.maxAge > 0:
+            now = time.monotonic()
+            while self.entries and now - self.entries[0][1] > self.maxAge:
+                self.remove(0)
+
+    def evict(self):
+        if self.policy == "keep-per-address":
+            # linear, but only up to the first device that was heard from again
+            for i, entry in enumerate(self.entries):
+                if entry[3] is None or self.perAddress[entry[3]] > 1:
+                    self.remove(i)
+                    return
+        self.remove(0)
+
+    def remove(self, i):
+        entry = self.entries[i]
+        del self.entries[i]
+        self.perAddress[entry[3]] -= 1
+        if not self.perAddress[entry[3]]:
+            del self.perAddress[entry[3]]
+
+    def select(self, prefixes=()):
+        # the entries starting with one of the prefixes (all without prefixes), oldest first
+        self.lock.acquire()
+        try:
+            self.expire()
+            return [entry for entry in self.entries if not prefixes or entry[2].startswith(prefixes)]
+        finally:
+            self.lock.release()
+
+    def since(self, wallTime, prefixes=()):
+        return [entry for entry in self.select(prefixes) if entry[0] >= wallTime]
+
+    def last(self, count, prefixes=()):
+        return self.select(prefixes)[-count:] if count > 0 else []
+
+
+class StateTable(object):
+    # the last telegram received from or sent to every device, by addressKey()
+    def __init__(self):
+        self.lock = Lock()
+        self.states = {}
+
+    def update(self, telegram, source, wallTime):
+        key = addressKey(telegram)
+        if key is None:
+            return
+        self.lock.acquire()
+        try:
+            self.states[key] = {"telegram": telegram, "source": source, "time": round(wallTime, 6)}
+        finally:
+            self.lock.release()
+
+    def query(self, prefix=""):
+        prefix = prefix.upper()
+        if prefix.startswith("K") and len(prefix) >= 3:
+            # "KB1" is K31 with a negative temperature
+            try:
+                prefix = "K%02X%s" % (int(prefix[1:3], 16) & 0x7F, prefix[3:])
+            except ValueError:
+                pass
+        self.lock.acquire()
+        try:
+            return dict((key, dict(state)) for key, state in self.states.items() if key.startswith(prefix))
+        finally:
+            self.lock.release()
+
+
+class Histogram(object):
+    # cumulative bucket counts as Prometheus expects them, observe() is a bisect and two additions
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.sum += value
+
+    def render(self, name, help):
+        lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+        total = 0
+        for bound, count in zip(self.BOUNDS + ("+Inf",), self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append("%s_sum %.6f" % (name, self.sum))
+        lines.append("%s_count %d" % (name, total))
+        return lines
+
+
+class RateMeter(object):
+    # events counted in one-second slots; rate() is the mean over the last complete seconds of the window
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self.slots = [0] * window
+        self.seconds = [0] * window
+
+    def add(self, count=1):
+        second = int(time.monotonic())
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.slots[slot] = 0
+        self.slots[slot] += count
+        self.total += count
+
+    def rate(self):
+        now = int(time.monotonic())
+        return sum(count for count, second in zip(self.slots, self.seconds)
+                   if now - self.window < second < now) / float(self.window - 1)
+
+
+class TimedLock(object):
+    # a Lock that adds up how long acquire() had to wait; the uncontended case costs one non-blocking attempt
+    def __init__(self):
+        self.lock = Lock()
+        self.contended = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        if self.lock.acquire(False):
+            return True
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.waited += time.perf_counter() - start
+        self.contended += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+
+class Metrics(object):
+    # counters the serial, sender and client threads update as they go; everything else is read when scraped.
+    # Updates are not locked, a lost increment under contention is acceptable for monitoring.
+    def __init__(self):
+        self.received = RateMeter()
+        self.sent = RateMeter()
+        self.ackLatency = Histogram()
+        self.transmitLatency = Histogram()
+        self.backoff = 0.0
+
+    def render(self, fs20):
+        sender = fs20.fs20Sender
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    labels = "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                               for k, v in labels)
+                lines.append("%s%s %s" % (name, labels or "", value))
+
+        metric("fs20_received_total", "counter", "radio telegrams received by the CULs, without their replies",
+               [((), self.received.total)])
+        metric("fs20_received_per_second", "gauge", "radio telegrams received per second, last 10s",
+               [((), "%.3f" % self.received.rate())])
+        metric("fs20_sent_total", "counter", "telegrams sent to the CULs", [((), self.sent.total)])
+        metric("fs20_sent_per_second", "gauge", "telegrams sent per second, last 10s", [((), "%.3f" % self.sent.rate())])
+        metric("fs20_send_queue_depth", "gauge", "telegrams waiting to be sent",
+               [((("priority", priority),), sender.sendQueue.qsize(priority)) for priority in CoalescingQueue.PRIORITIES])
+        metric("fs20_send_queue_coalesced_total", "counter", "queued commands replaced by a newer one",
+               [((), sender.sendQueue.coalesced)])
+        lines.extend(self.ackLatency.render("fs20_ack_latency_seconds", "time from writing to the CUL until its reply"))
+        lines.extend(self.transmitLatency.render("fs20_transmit_latency_seconds",
+                                                 "time from taking a telegram off the queue until it was sent"))
+        metric("fs20_lovf_total", "counter", "LOVF replies", [((), sender.lovfCount)])
+        metric("fs20_backoff_seconds_total", "counter", "time spent waiting for duty cycle credit",
+               [((), "%.3f" % self.backoff)])
+        metric("fs20_credit_seconds", "gauge", "duty cycle credit left",
+               [((("stick", stick.id()),), "%.2f" % stick.budget.available()) for stick in fs20.connectedSticks()])
+        metric("fs20_serial_reconnects_total", "counter", "times a CUL stopped working and was reopened",
+               [((("stick", stick.id()),), stick.reconnects) for stick in fs20.sticks])
+        metric("fs20_duplicates_total", "counter", "repeated frames not passed on",
+               [((), fs20.deduplicator.suppressed)])
+        clients = list(fs20.clients)
+        metric("fs20_clients", "gauge", "connected clients", [((), len(clients))])
+        metric("fs20_client_backlog", "gauge", "lines queued for a client",
+               [((("client", client.id()),), len(client.sendQueue)) for client in clients])
+        metric("fs20_client_dropped_total", "counter", "lines dropped because a client did not keep up",
+               [((("client", client.id()),), client.sendQueue.dropped) for client in clients])
+        metric("fs20_serial_lock_contended_total", "counter", "times a CUL's write lock was held by another thread",
+               [((("stick", stick.id()),), stick.lock.contended) for stick in fs20.sticks])
+        metric("fs20_serial_lock_wait_seconds_total", "counter", "time spent waiting for a CUL's write lock",
+               [((("stick", stick.id()),), "%.6f" % stick.lock.waited) for stick in fs20.sticks])
+        return "\n".join(lines) + "\n"
+
+
+class SubscriptionIndex(object):
+    # which clients get a telegram: the ones without a subscription get everything, the others are looked up
+    # by the telegram's first characters, one dict lookup per distinct prefix length; never changed once built
+    def __init__(self, subscriptions):
+        self.everyone = tuple(client for client, prefixes in subscriptions.items() if not prefixes)
+        byPrefix = {}
+        for client, prefixes in subscriptions.items():
+            for prefix in prefixes:
+                byPrefix.setdefault(prefix, []).append(client)
+        self.byPrefix = dict((prefix, tuple(clients)) for prefix, clients in byPrefix.items())
+        self.lengths = tuple(sorted(set(len(prefix) for prefix in byPrefix)))
+
+    def recipients(self, telegram):
+        matches = [self.byPrefix[telegram[:n]] for n in self.lengths if telegram[:n] in self.byPrefix]
+        if not matches:
+            return self.everyone
+        if len(matches) == 1:
+            return self.everyone + matches[0]
+        # a client subscribed to several matching prefixes gets the telegram once
+        return self.everyone + tuple(set(client for clients in matches for client in clients))
+
+
+class CulStick(Thread):
+    # one CUL: reads its telegrams, keeps its own duty cycle budget; tries the devices in order until one opens
+    def __init__(self, devices, fs20, logger):
         Thread.__init__(self)
-        self.cul = None
-        self.clients = []
-        self.logger = logger
+        self.daemon = True
         self.devices = devices
+        self.fs20 = fs20
+        self.logger = logger
+        self.cul = None
+        self.reader = None
         self.connectedDevice = ""
-        self.lock = Lock()
-        self.log("starting Sender Thread")
-        self.fs20Sender = Fs20Sender(self, logger)
-        self.fs20Sender.daemon = True
-        self.fs20Sender.start()
-        self.log("Sender Thread started")
+        # serial writes: the sender's commands and credit polls
+        self.lock = TimedLock()
+        self.budget = DutyCycle()
+        self.creditUpdated = Event()
+        self.lastCreditPoll = 0.0
+        self.reconnects = 0
 
     def connectDevice(self):
         while self.connectedDevice == "":
             for device in self.devices:
                 try:
-                    self.cul = serial.Serial(device, 9600)
+                    self.cul = serial.Serial(device, 9600, timeout=1)
+                    self.reader = CulReader(self.cul)
                     self.connectedDevice = device
-                    self.writeToCul("X01")
+                    self.write("X01")
                     self.log("connected to device " + device)
                     return
                 except serial.SerialException as exc:
                     self.log("problem with the CUL device: %s" % exc)
             time.sleep(60)
 
+    def run(self):
+        self.connectDevice()
+        while True:
+            try:
+                telegrams = self.reader.read()
+            except Exception as exc:
+                self.log("Device %s stopped working: %s" % (self.connectedDevice, exc))
+                self.connectedDevice = ""
+                self.reconnects += 1
+                self.connectDevice()
+                continue
+            for telegram in telegrams:
+                self.fs20.received(self, telegram, self.reader.stamp)
+
+    def write(self, telegram):
+        telegram = telegram.replace('\r', '')
+        self.lock.acquire()
+        try:
+            self.log("writing %s to CUL" % telegram)
+            self.cul.write((telegram + '\r\n').encode())
+            return True
+        except Exception as exc:
+            self.log("cannot write %s to CUL: %s" % (telegram, exc))
+            return False
+        finally:
+            self.lock.release()
+
+    def id(self):
+        return self.connectedDevice or "/".join(self.devices)
+
+    def log(self, logStr):
+        self.logger.log("CulStick %s: %s" % (self.id(), logStr))
+
+
+class Fs20(Thread):
+    def __init__(self, devices, logger, config):
+        Thread.__init__(self)
+        self.config = config
+        self.clients = []
+        # address prefixes per client, an empty set means everything
+        self.subscriptions = {}
+        self.index = SubscriptionIndex({})
+        self.logger = logger
+        self.devices = devices
+        if config.sticks == "active":
+            # every stick receives and transmits
+            self.sticks = [CulStick([device], self, logger) for device in devices]
+        else:
+            # the first stick that opens is used, the others are spares
+            self.sticks = [CulStick(devices, self, logger)]
+        self.lock = Lock()
+        self.metrics = Metrics()
+        self.deduplicator = Deduplicator(config.dedupWindow, config.mergeWindow if len(self.sticks) > 1 else 0.0)
+        self.replayBuffer = ReplayBuffer(config.replaySize, config.replayMaxAge, config.replayPolicy)
+        self.stateTable = StateTable()
+        self.log("starting Sender Thread")
+        self.fs20Sender = Fs20Sender(self, logger)
+        self.fs20Sender.daemon = True
+        self.fs20Sender.start()
+        self.log("Sender Thread started")
+
+    def connectedSticks(self):
+        return [stick for stick in self.sticks if stick.connectedDevice]
+
     def addClient(self, client):
         self.lock.acquire()
         try:
             self.clients.append(client)
+            self.subscriptions[client] = set()
+            self.index = SubscriptionIndex(self.subscriptions)
             self.log("add client " + client.id())
         finally:
             self.lock.release()
@@ -79,46 +882,111 @@ class Fs20(Thread):
         try:
             self.log("remove client " + client.id())
             self.clients.remove(client)
+            del self.subscriptions[client]
+            self.index = SubscriptionIndex(self.subscriptions)
         finally:
             self.lock.release()
 
-    def run(self):
-        self.log("started")
-        self.connectDevice()
-        while True:
-            c = ''
-            telegram = ''
-            while c != '\n':
-                try:
-                    c = self.cul.read(1).decode()
-                except Exception as exc:
-                    self.log("Device %s stopped working: %s" % (self.connectedDevice, exc))
-                    self.connectedDevice = ""
-                    self.connectDevice()
-                    c = ''
-                    telegram = ''
-                telegram += c
-            telegram = telegram[:-2]
-            self.log("received FS20 telegram %s" % telegram)
-            self.distribute(telegram)
-
-    def distribute(self, telegram):
-        for client in self.clients:
-            client.received(telegram)
-
-    def send(self, telegram):
-        self.fs20Sender.send(telegram)
-        self.distribute(telegram)
-
-    def writeToCul(self, telegram):
-        telegram = telegram.replace('\r', '')
+    def subscribe(self, client, prefixes, unsubscribe=False):
+        # returns the client's prefixes afterwards; unsubscribing from everything means getting everything again
         self.lock.acquire()
         try:
-            self.log("writing %s to CUL" % telegram)
-            self.cul.write((telegram + '\r\n').encode())
+            if client not in self.subscriptions:
+                return set()
+            if not unsubscribe:
+                self.subscriptions[client].update(prefix.upper() for prefix in prefixes)
+            elif prefixes:
+                self.subscriptions[client].difference_update(prefix.upper() for prefix in prefixes)
+            else:
+                self.subscriptions[client].clear()
+            self.index = SubscriptionIndex(self.subscriptions)
+            return set(self.subscriptions[client])
         finally:
             self.lock.release()
 
+    def run(self):
+        self.log("started")
+        for stick in self.sticks:
+            stick.start()
+        for stick in self.sticks:
+            stick.join()
+
+    def received(self, stick, telegram, stamp=None):
+        # called by the stick threads with everything their CUL reports, stamp is (wall clock, monotonic)
+        # taken when the serial read returned
+        self.log("received FS20 telegram %s from %s" % (telegram, stick.id()))
+        if self.fs20Sender.received(stick, telegram):
+            return
+        if not self.fs20Sender.isReply(telegram):
+            # the echo of our own telegram is no news about the device, __transmit records what was sent
+            self.metrics.received.add()
+            self.stateTable.update(telegram, "rx", stamp[0] if stamp else time.time())
+        self.distribute(telegram, self.deduplicator.isDuplicate(telegram, stick), stamp)
+
+    def distribute(self, telegram, duplicate=False, stamp=None):
+        # duplicates only go to clients that asked for raw frames;
+        # clients that asked for timestamps get "<telegram>;<wall clock>;<monotonic>"
+        if stamp is None:
+            stamp = (time.time(), time.monotonic())
+        if not duplicate:
+            self.replayBuffer.append(telegram, stamp)
+        stamped = "%s;%.6f;%.6f" % (telegram, stamp[0], stamp[1])
+        for client in self.index.recipients(telegram):
+            if client.raw or not duplicate:
+                client.received(stamped if client.timestamps else telegram)
+
+    def send(self, telegram, priority="normal"):
+        self.fs20Sender.send(telegram, priority)
+        self.distribute(telegram)
+
+    def replay(self, client, mode, argument):
+        # the buffered telegrams this client would have got, in the client's line format
+        prefixes = tuple(self.subscriptions.get(client, ()))
+        if mode == "since":
+            entries = self.replayBuffer.since(float(argument), prefixes)
+        else:
+            entries = self.replayBuffer.last(int(argument), prefixes)
+        for wall, mono, telegram, key in entries:
+            client.received("%s;%.6f;%.6f" % (telegram, wall, mono) if client.timestamps else telegram)
+        return len(entries)
+
+    def request(self, client, line):
+        # a line from a client: server commands start with '!', everything else goes to the CUL,
+        # optionally marked with its priority class, e.g. "bulk:F404B8111"
+        if not line.startswith("!"):
+            priority, separator, telegram = line.partition(":")
+            if separator and priority in CoalescingQueue.PRIORITIES:
+                self.send(telegram, priority)
+            else:
+                self.send(line)
+            return
+        args = line[1:].split()
+        if args == ["budget"]:
+            client.received("!budget %s" % json.dumps(self.fs20Sender.budgetStatus()))
+        elif args == ["queue"]:
+            client.received("!queue %s" % json.dumps(self.fs20Sender.queueStatus()))
+        elif args[:1] == ["raw"] and args[1:] in ([], ["on"], ["off"]):
+            client.raw = args[1:] != ["off"]
+            client.received("!raw %s" % ("on" if client.raw else "off"))
+        elif args[:1] == ["timestamps"] and args[1:] in ([], ["on"], ["off"]):
+            client.timestamps = args[1:] != ["off"]
+            client.received("!timestamps %s" % ("on" if client.timestamps else "off"))
+        elif args[:1] in (["subscribe"], ["unsubscribe"]):
+            prefixes = self.subscribe(client, args[1:], args[0] == "unsubscribe")
+            client.received("!subscribe %s" % " ".join(sorted(prefixes)))
+        elif args[:1] == ["replay"] and len(args) == 3 and args[1] in ("since", "last"):
+            try:
+                client.received("!replay %d" % self.replay(client, args[1], args[2]))
+            except ValueError:
+                client.received("!error invalid argument '%s'" % line)
+        elif args[:1] == ["state"] and len(args) <= 2:
+            client.received("!state %s" % json.dumps(self.stateTable.query(*args[1:]), sort_keys=True))
+        elif args == ["dedup"]:
+            client.received("!dedup %s" % json.dumps({"window": self.deduplicator.dedupWindow,
+                                                      "suppressed": self.deduplicator.suppressed}))
+        else:
+            client.received("!error unknown command '%s'" % line)
+
     def log(self, logStr):
         self.logger.log("Fs20: %s" % logStr)
 
@@ -126,51 +994,169 @@ class Fs20(Thread):
 class Fs20Sender(Thread):
     def __init__(self, fs20, logger):
         Thread.__init__(self)
-        self.sendQueue = queue.Queue()
+        self.sendQueue = CoalescingQueue(fs20.config.starvationTimeout)
         self.recvQueue = queue.Queue()
         self.listenEvents = Event()
         self.listenEvents.clear()
+        # the telegram written to a CUL while listenEvents is set, its echo is a reply and not a radio telegram
+        self.transmitting = None
         self.logger = logger
         self.running = True
         self.fs20 = fs20
-        fs20.addClient(self)
+        # smoothed reply time and its variation (as for TCP retransmission timeouts), None until the first reply
+        self.replyTime = None
+        self.replyTimeVar = None
+        self.ackTimeout = fs20.config.ackTimeoutMax
+        self.sentCount = 0
+        self.sentLatency = 0.0
+        self.lovfCount = 0
+        # per priority class: number of sent telegrams, total and longest time they waited in the queue
+        self.waitStats = dict((priority, [0, 0.0, 0.0]) for priority in CoalescingQueue.PRIORITIES)
 
-    def send(self, telegram):
-        self.listenEvents.set()
-        self.sendQueue.put(telegram)
+    def send(self, telegram, priority="normal"):
+        for dropped in self.sendQueue.put(telegram, priority):
+            self.log("not sending %s, superseded by %s" % (dropped, telegram))
 
     def run(self):
         while self.running:
-            telegram = self.sendQueue.get()
-            self.__transmit(telegram)
+            try:
+                telegram, priority, enqueued = self.sendQueue.get(True, self.fs20.config.creditPollInterval)
+            except queue.Empty:
+                telegram = None
+            for stick in self.fs20.connectedSticks():
+                if time.monotonic() - stick.lastCreditPoll > self.fs20.config.creditPollInterval:
+                    self.__pollCredit(stick)
+            if telegram is not None:
+                self.__transmit(telegram, priority, enqueued)
         self.log("exit")
 
-    def __transmit(self, telegram):
-        sent = False
-        self.log("sending %s" % telegram)
-        while not sent:
-            self.fs20.writeToCul(telegram)
-            ack = False
-            while (not ack):
-                try:
-                    reply = self.recvQueue.get(True, 1)
-                    self.log("got %s" % reply)
-                    if "LOVF" in reply:
-                        self.log("received LOVF, trying again in 22 seconds")
-                        ack = True
-                        time.sleep(22)
-                except queue.Empty:
-                    sent = True
-                    ack = True
+    def budgetStatus(self):
+        sticks = self.fs20.connectedSticks()
+        return {"credit": round(sum(stick.budget.available() for stick in sticks), 2),
+                "capacity": DutyCycle.CAPACITY * len(sticks),
+                "sticks": dict((stick.id(), round(stick.budget.available(), 2)) for stick in sticks),
+                "queued": round(sum(estimateAirtime(t) for t in self.sendQueue.telegrams()), 2),
+                "queueLength": self.sendQueue.qsize(), "lovf": self.lovfCount}
+
+    def queueStatus(self):
+        status = {"queueLength": self.sendQueue.qsize(), "coalesced": self.sendQueue.coalesced,
+                  "dropped": self.sendQueue.dropped}
+        for priority, (count, total, longest) in self.waitStats.items():
+            status[priority] = {"queueLength": self.sendQueue.qsize(priority), "sent": count,
+                                "meanWait": round(total / count, 3) if count else 0.0, "maxWait": round(longest, 3)}
+        return status
+
+    def __pollCredit(self, stick):
+        # ask the CUL for its remaining credit ('X'), the reply is picked up by received()
+        stick.lastCreditPoll = time.monotonic()
+        stick.creditUpdated.clear()
+        if stick.write("X") and stick.creditUpdated.wait(self.fs20.config.ackTimeoutMax):
+            self.log("%s reports %.2fs credit" % (stick.id(), stick.budget.available()))
+        else:
+            self.log("no reply to credit poll from %s" % stick.id())
+
+    def __transmit(self, telegram, priority, enqueued):
+        self.log("sending %s (%s)" % (telegram, priority))
+        start = time.monotonic()
+        needed = estimateAirtime(telegram)
+        reserve = self.fs20.config.creditReserve
+        if priority == "bulk":
+            reserve += self.fs20.config.bulkReserve
+        while True:
+            sticks = self.fs20.connectedSticks()
+            if not sticks:
+                self.log("no CUL connected, cannot send %s yet" % telegram)
+                time.sleep(5)
+                continue
+            # the stick with the most credit left
+            stick = max(sticks, key=lambda stick: stick.budget.available())
+            wait = stick.budget.waitTime(needed + reserve)
+            if wait > 0:
+                self.log("duty cycle: %.2fs credit left, waiting %.1fs before sending %s" % (
+                    stick.budget.available(), wait, telegram))
+                backoffStart = time.monotonic()
+                moreUrgent = self.sendQueue.waitForMoreUrgent(priority, wait)
+                self.fs20.metrics.backoff += time.monotonic() - backoffStart
+                if moreUrgent:
+                    # let the more urgent telegram go first, this one stays at the head of its class
+                    self.sendQueue.put(telegram, priority, enqueued, front=True)
+                    return
+                continue
+            while not self.recvQueue.empty():
+                self.recvQueue.get()
+            self.transmitting = telegram.replace('\r', '').strip()
+            self.listenEvents.set()
+            if not stick.write(telegram):
+                time.sleep(1)
+                continue
+            self.fs20.deduplicator.seen(telegram)
+            result = self.__awaitReply(stick, telegram.replace('\r', '').strip(), time.monotonic())
+            if result != "LOVF":
+                stick.budget.consume(needed)
+                break
+            # the CUL needs more credit than it has, wait until there is more than it reports now
+            self.lovfCount += 1
+            stick.budget.update(0.0)
+            self.__pollCredit(stick)
+            needed = max(needed, stick.budget.available() + 0.1)
+            self.log("received LOVF from %s, %.2fs credit left, need %.2fs" % (
+                stick.id(), stick.budget.available(), needed))
         self.listenEvents.clear()
-        self.log("successfully sent %s" % telegram)
+        self.transmitting = None
+        # only now, a queued command may still be coalesced away or wait minutes for credit
+        self.fs20.stateTable.update(telegram.replace('\r', '').strip(), "tx", time.time())
+        stats = self.waitStats[priority]
+        stats[0] += 1
+        stats[1] += start - enqueued
+        stats[2] = max(stats[2], start - enqueued)
+        latency = time.monotonic() - start
+        self.sentCount += 1
+        self.sentLatency += latency
+        self.fs20.metrics.sent.add()
+        self.fs20.metrics.transmitLatency.observe(latency)
+        self.log("successfully sent %s (%s after %.3fs, average %.3fs, reply timeout %.3fs)" % (
+            telegram, result, latency, self.sentLatency / self.sentCount, self.ackTimeout))
 
-    def received(self, telegram):
-        if self.listenEvents.isSet():
-            self.recvQueue.put(telegram)
+    def __awaitReply(self, stick, telegram, written):
+        # done when a CUL reports the telegram (echo), the sending one LOVF, or nothing came within the learned timeout
+        deadline = written + self.ackTimeout
+        while True:
+            try:
+                replyStick, reply = self.recvQueue.get(True, max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return "timeout"
+            self.log("got %s from %s" % (reply, replyStick.id()))
+            if "LOVF" in reply and replyStick is stick:
+                self.__learnReplyTime(time.monotonic() - written)
+                return "LOVF"
+            if reply.startswith(telegram):
+                self.__learnReplyTime(time.monotonic() - written)
+                return "echo"
 
-    def id(self):
-        return "Fs20Sender"
+    def __learnReplyTime(self, replyTime):
+        self.fs20.metrics.ackLatency.observe(replyTime)
+        if self.replyTime is None:
+            self.replyTime = replyTime
+            self.replyTimeVar = replyTime / 2
+        else:
+            self.replyTimeVar = 0.75 * self.replyTimeVar + 0.25 * abs(self.replyTime - replyTime)
+            self.replyTime = 0.875 * self.replyTime + 0.125 * replyTime
+        self.ackTimeout = min(max(self.replyTime + 4 * self.replyTimeVar, self.fs20.config.ackTimeoutMin),
+                              self.fs20.config.ackTimeoutMax)
+
+    def received(self, stick, telegram):
+        # everything the CULs report; returns True for credit replies, which are not passed on to the clients
+        if stick.budget.parseStatus(telegram):
+            stick.creditUpdated.set()
+            return True
+        if self.listenEvents.is_set():
+            self.recvQueue.put((stick, telegram))
+        return False
+
+    def isReply(self, telegram):
+        # LOVF or the echo of the telegram being sent, what the CULs report besides radio telegrams and credit
+        transmitting = self.transmitting
+        return "LOVF" in telegram or (transmitting is not None and telegram.startswith(transmitting))
 
     def log(self, logStr):
         self.logger.log("Fs20Sender: " + logStr)
@@ -226,17 +1212,39 @@ class RequestHandler(Thread):
         self.connection = connection
         self.fs20 = fs20
         self.logger = logger
+        self.sendQueue = OutboundQueue(fs20.config.queueSize, fs20.config.overflowPolicy)
+        self.raw = False
+        self.timestamps = False
 
     def log(self, logStr):
         self.logger.log("RequestHandler %s: %s" % (self.connection[1], logStr))
 
     def received(self, telegram):
-        self.connection[0].sendall(("%s\n" % telegram).encode())
+        self.sendQueue.put(("%s\n" % telegram).encode())
 
     def id(self):
         return self.connection[1]
 
+    def writeQueued(self):
+        while True:
+            items = self.sendQueue.getAll()
+            if self.sendQueue.closed:
+                break
+            try:
+                self.connection[0].sendall(b"".join(items))
+            except Exception as exc:
+                self.log("Exception %s while sending to connection %s" % (exc, self.connection[1]))
+                break
+        # wakes up the receiving side if the queue overflowed with policy 'disconnect'
+        try:
+            self.connection[0].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def run(self):
+        writer = Thread(target=self.writeQueued)
+        writer.daemon = True
+        writer.start()
         self.fs20.addClient(self)
         recvBuffer = ""
         while True:
@@ -253,16 +1261,182 @@ class RequestHandler(Thread):
             recvBuffer += recvStr.decode()
             telegrams = recvBuffer.split("\n")
             for telegram in telegrams[:-1]:
-                self.fs20.send(telegram)
+                self.fs20.request(self, telegram)
             recvBuffer = telegrams[-1]
-        self.log("Closed connection " + self.connection[1])
+        self.sendQueue.close()
+        self.connection[0].close()
+        self.log("Closed connection %s, %d telegrams dropped" % (self.connection[1], self.sendQueue.dropped))
+
+
+class AsyncSocketServer(SocketServer):
+    # all client connections on one event loop instead of one RequestHandler thread each
+    def __init__(self, host, port, fs20, logger):
+        super().__init__(host, port, fs20, logger)
+        self.loop = None
+
+    def run(self):
+        self.prepare()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.log("keyboard interrupt")
+            self.socket.close()
+            self.logger.stop()
+            sys.exit(1)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.accept, sock=self.socket, backlog=100)
+        async with server:
+            await server.serve_forever()
+
+    async def accept(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        self.log(addr[0] + ':' + str(addr[1]) + " connected")
+        await AsyncRequestHandler(reader, writer, "%s:%d" % addr[:2], self.loop, self.fs20, self.logger).run()
+
+
+class AsyncRequestHandler(object):
+    def __init__(self, reader, writer, name, loop, fs20, logger):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.loop = loop
+        self.fs20 = fs20
+        self.logger = logger
+        self.sendQueue = OutboundQueue(fs20.config.queueSize, fs20.config.overflowPolicy)
+        self.raw = False
+        self.timestamps = False
+        self.wakeup = asyncio.Event()
+
+    def log(self, logStr):
+        self.logger.log("AsyncRequestHandler %s: %s" % (self.name, logStr))
+
+    def received(self, telegram):
+        # called from the serial thread, only wakes up the writer on the event loop when needed
+        if self.sendQueue.put(("%s\n" % telegram).encode()):
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def id(self):
+        return self.name
+
+    async def writeQueued(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            items = self.sendQueue.getAll(0)
+            if self.sendQueue.closed:
+                break
+            if items:
+                self.writer.write(b"".join(items))
+                await self.writer.drain()
+
+    async def run(self):
+        writeTask = asyncio.ensure_future(self.writeQueued())
+        writeTask.add_done_callback(lambda task: self.writer.close())
+        self.fs20.addClient(self)
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line.endswith(b"\n"):
+                    self.log("Received nil data from connection " + self.name)
+                    break
+                self.fs20.request(self, line[:-1].decode())
+        except Exception as exc:
+            self.log("Exception %s while receiving from connection %s" % (exc, self.name))
+        self.fs20.delClient(self)
+        self.sendQueue.close()
+        writeTask.cancel()
+        self.writer.close()
+        self.log("Closed connection %s, %d telegrams dropped" % (self.name, self.sendQueue.dropped))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.fs20.metrics.render(self.server.fs20).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(Thread):
+    # Prometheus text format over HTTP, rendered on every request
+    def __init__(self, host, port, fs20, logger):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.fs20 = fs20
+
+    def run(self):
+        self.log("serving metrics on port %d" % self.server.server_address[1])
+        self.server.serve_forever()
+
+    def log(self, logStr):
+        self.logger.log("MetricsServer: " + logStr)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("usage: %s <port> <devices>" % sys.argv[0])
+    args = sys.argv[1:]
+    config = Config()
+    if "--config" in args[:-1]:
+        i = args.index("--config")
+        config.read(args[i + 1])
+        del args[i:i + 2]
+    if len(args) < 2 or not config.validate():
+        print("usage: %s <port> <devices> [--config <file>]" % sys.argv[0])
         print("ex:    %s 7890 /dev/ttyACM0 /dev/ttyACM1 /dev/ttyACM2" % sys.argv[0])
+        print("")
+        print("<file> may contain:")
+        print("  server: threaded|asyncio  (one thread per client or all clients on one event loop, default threaded)")
+        print("  sticks: failover|active   (use the first device that opens or all of them at once, default failover)")
+        print("  mergeWindow: <seconds>    (a telegram another stick received within this time is dropped, default 0.5)")
+        print("  dedupWindow: <seconds>    (repeats of a telegram within this time are dropped, 0 = off, default 0.5)")
+        print("  logPrefix: <path>         (default /var/log/fs20/fs20)")
+        print("  queueSize: <n>            (telegrams queued per client before overflowPolicy applies, default 1000)")
+        print("  overflowPolicy: drop-oldest|drop-newest|disconnect  (default drop-oldest)")
+        print("  ackTimeoutMin: <seconds>  (lower bound of the reply timeout learned from echo/LOVF times, default 0.1)")
+        print("  ackTimeoutMax: <seconds>  (reply timeout until the first reply was seen, upper bound, default 1.0)")
+        print("  creditPollInterval: <seconds>  (how often the CUL's duty cycle credit is read, default 60)")
+        print("  creditReserve: <seconds>  (credit always left unused, default 0.1)")
+        print("  bulkReserve: <seconds>    (additional credit bulk telegrams leave for the others, default 2)")
+        print("  starvationTimeout: <seconds>  (a less urgent telegram waiting this long goes next, default 30)")
+        print("  metricsPort: <port>       (serve counters and histograms in Prometheus text format, default 0: off)")
+        print("  replaySize: <n>           (telegrams kept for '!replay', 0 disables it, default 1000)")
+        print("  replayMaxAge: <seconds>   (telegrams older than this are dropped from it, 0: no limit, default 3600)")
+        print("  replayPolicy: drop-oldest|keep-per-address  (which telegram to drop when it is full)")
+        print("")
+        print("clients send one telegram per line, optionally prefixed with its priority class:")
+        print("'interactive:', 'normal:' (default) or 'bulk:'")
+        print("'!budget' returns the duty cycle budget as JSON, '!queue' the send queue length, how many commands")
+        print("were coalesced and dropped and the queue wait times per priority class")
+        print("'!raw [on|off]' passes repeated frames to this client, '!dedup' returns how many were suppressed")
+        print("'!timestamps [on|off]' appends when the telegram was received: '<telegram>;<time>;<monotonic>',")
+        print("<time> in seconds since the epoch, <monotonic> comparable to time.monotonic() on this host")
+        print("'!replay since <time>' or '!replay last <n>' sends the telegrams received since <time> (seconds since")
+        print("the epoch) or the last <n> telegrams again, followed by '!replay <count>'")
+        print("'!state [<address or prefix>]' returns the last telegram from or to every device (or the matching ones)")
+        print("as JSON, e.g. '!state F404B81' or '!state K31'")
+        print("'!subscribe <prefix> ...' only passes telegrams starting with one of the prefixes to this client,")
+        print("'!unsubscribe [<prefix> ...]' removes them again (all of them without arguments)")
         sys.exit(-1)
-    logger = Logger("/var/log/fs20/fs20")
-    fs20 = Fs20(sys.argv[2:], logger)
-    SocketServer(host="", port=int(sys.argv[1]), fs20=fs20, logger=logger).run()
+    logger = Logger(config.logPrefix)
+    fs20 = Fs20(args[1:], logger, config)
+    if config.metricsPort:
+        MetricsServer("", config.metricsPort, fs20, logger).start()
+
+    def terminate(signum, frame):
+        # systemd stop, kill: shut down as on Ctrl-C, which writes out what the Logger still holds
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, terminate)
+    if config.server == "asyncio":
+        AsyncSocketServer(host="", port=int(args[0]), fs20=fs20, logger=logger).run()
+    else:
+        SocketServer(host="", port=int(args[0]), fs20=fs20, logger=logger).run()
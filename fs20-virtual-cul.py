@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import collections
+import os
+import sys
+import threading
+import time
+import tty
+
+
+class VirtualCulConfig(object):
+    def __init__(self):
+        self.link = ""
+        self.rate = 1.0
+        self.s300th = 1
+        self.hms100t = 4
+        self.fs20 = 2
+        self.credit = 9.0
+        self.repeats = 1
+
+    def parse(self, args):
+        # "--<key> <value>" pairs, converted to the type of the default
+        while len(args) >= 2 and args[0].startswith("--"):
+            k, v = args[0][2:], args[1]
+            if not hasattr(self, k):
+                sys.stderr.write("unknown option '--%s'\n" % k)
+            else:
+                setattr(self, k, type(getattr(self, k))(v))
+            args = args[2:]
+        return args
+
+
+def frameTime(telegram):
+    # what culfw charges for an FS20 frame: sync, 9 bits per byte (checksum included) at 1ms on average, 3 repeats
+    # with 10ms pauses; anything else is not sent over the air
+    if not telegram.startswith("F") or len(telegram) < 9:
+        return 0.0
+    return 3 * (13 + 9 * (len(telegram[1:]) // 2 + 1) + 1) * 0.001 + 2 * 0.01
+
+
+def simulatedTelegrams(config):
+    # one telegram per simulated sender in turn, values change with every round
+    senders = ([("K", i) for i in range(config.s300th)] + [("H", i) for i in range(config.hms100t)] +
+               [("F", i) for i in range(config.fs20)])
+    round = 0
+    while True:
+        for kind, i in senders:
+            temperature = (round * 7 + i * 13) % 400 - 100
+            humidity = (round * 3 + i * 11) % 900 + 100
+            t = "%03d" % abs(temperature)
+            h = "%03d" % humidity
+            if kind == "K":
+                # S300TH: address in the second nibble, the sign in bit 3 of the first
+                yield "K%X%X%s%s%s%s%s%s" % (0x3 | (8 if temperature < 0 else 0), i + 1, t[1], t[2], h[2], t[0],
+                                             h[0], h[1])
+            elif kind == "H":
+                # HMS100T "H155601150100": address, sign and status, temperature and humidity digits
+                yield "H%04X%X1%s%s%s%s%s%s" % ((0x1556 + i * 0x1111) & 0xFFFF, 8 if temperature < 0 else 0,
+                                                t[1], t[2], h[2], t[0], h[0], h[1])
+            else:
+                yield "F%04X%02X%02X" % (0x5E7E + i, 0x10 + i, round % 0x12)
+        round += 1
+
+
+class VirtualCul(object):
+    # a CUL behind a pseudo terminal: answers 'X' and 'V', echoes FS20 telegrams after their airtime or answers LOVF
+    # when the 1% duty cycle credit is used up, and reports telegrams from simulated S300TH, HMS100T and FS20 senders
+    def __init__(self, config):
+        self.config = config
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        if config.link:
+            if os.path.lexists(config.link):
+                os.remove(config.link)
+            os.symlink(self.path, config.link)
+            self.path = config.link
+        self.writeLock = threading.Lock()
+        self.credit = config.credit
+        self.updated = time.monotonic()
+        self.emitted = 0
+        self.lovfCount = 0
+        # (monotonic time the CUL got it, telegram) for every FS20 telegram it was asked to send
+        self.transmitted = collections.deque(maxlen=100000)
+        self.onEmit = None
+        self.running = True
+
+    def start(self):
+        for target in (self.readCommands, self.generate):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.config.link and os.path.islink(self.config.link):
+            os.remove(self.config.link)
+
+    def write(self, line):
+        self.writeLock.acquire()
+        try:
+            os.write(self.master, (line + "\r\n").encode())
+        finally:
+            self.writeLock.release()
+
+    def availableCredit(self):
+        now = time.monotonic()
+        self.credit = min(self.credit + (now - self.updated) * 0.01, self.config.credit)
+        self.updated = now
+        return self.credit
+
+    def readCommands(self):
+        buffer = b""
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                time.sleep(0.1)
+                continue
+            lines = (buffer + data).split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                command = line.decode(errors="replace").strip()
+                if command:
+                    self.handle(command)
+
+    def handle(self, command):
+        if command == "X":
+            self.write("21 %4d" % int(self.availableCredit() * 100))
+        elif command == "V":
+            self.write("V 1.67 CUL868")
+        elif command.startswith("F"):
+            self.transmitted.append((time.monotonic(), command))
+            airtime = frameTime(command)
+            if self.availableCredit() < airtime:
+                self.lovfCount += 1
+                self.write("LOVF")
+                return
+            self.credit -= airtime
+            time.sleep(airtime)
+            self.write(command)
+
+    def generate(self):
+        if self.config.rate <= 0:
+            return
+        interval = 1.0 / self.config.rate
+        due = time.monotonic()
+        for telegram in simulatedTelegrams(self.config):
+            if not self.running:
+                break
+            due += interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for i in range(self.config.repeats):
+                if self.onEmit:
+                    self.onEmit(telegram, time.monotonic())
+                self.write(telegram)
+            self.emitted += 1
+
+
+if __name__ == "__main__":
+    config = VirtualCulConfig()
+    if config.parse(sys.argv[1:]):
+        print("usage: %s [--<option> <value> ...]" % sys.argv[0])
+        print("ex:    %s --link /tmp/ttyCUL0 --rate 5" % sys.argv[0])
+        print("")
+        print("options:")
+        print("  link: <path>     (symlink to the pseudo terminal, default: none, its name is printed)")
+        print("  rate: <n>        (telegrams per second from the simulated senders, default 1, 0: none)")
+        print("  s300th: <n>      (simulated S300TH senders, default 1)")
+        print("  hms100t: <n>     (simulated HMS100T senders, default 4)")
+        print("  fs20: <n>        (simulated FS20 remotes, default 2)")
+        print("  credit: <seconds>  (duty cycle credit, 1% airtime refills 10ms per second, default 9)")
+        print("  repeats: <n>     (times every telegram is reported, like repeated frames, default 1)")
+        sys.exit(-1)
+    cul = VirtualCul(config)
+    cul.start()
+    print(cul.path)
+    try:
+        while True:
+            time.sleep(10)
+            print("%d telegrams reported, %d sent, %d LOVF" % (cul.emitted, len(cul.transmitted), cul.lovfCount))
+    except KeyboardInterrupt:
+        cul.stop()
@@ -0,0 +1,11 @@
+import importlib.util
+import os
+
+
+def loadScript(fileName):
+    # the daemons are plain scripts with dashes in their names, so they cannot be imported the usual way
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), fileName)
+    spec = importlib.util.spec_from_file_location(fileName[:-3].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module